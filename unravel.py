@@ -11,7 +11,6 @@ from unravel import *
 from unravel.hilda import *
 
 import multiprocessing
-import copy
 
 
 def cli_args():
@@ -29,7 +28,7 @@ def cli_args():
 def run_algo_on_hilda(algo):
     """Run algorithm `algo` on HILDA and write causal graph to pickle."""
     print("Running %s algorithm." % algo)
-    g = algos[algo].predict(hilda)
+    g = algos[algo].predict(dataset('hilda'))
     pname = "graph-" + algo + ".pickle"
     with open(pname, "wb") as f:
         print("Writing output of %s to %s." % (algo, pname))
@@ -38,7 +37,7 @@ def run_algo_on_hilda(algo):
 def run_algo_on_hilda1k(algo):
     """Run algorithm `algo` on HILDA and write causal graph to pickle."""
     print("Running %s algorithm." % algo)
-    g = algos[algo].predict(hilda1k)
+    g = algos[algo].predict(dataset('hilda1k'))
     pname = "graph-" + algo + "-hilda1k" + ".pickle"
     with open(pname, "wb") as f:
         print("Writing output of %s to %s." % (algo, pname))
@@ -47,7 +46,7 @@ def run_algo_on_hilda1k(algo):
 def run_algo_on_hilda100(algo):
     """Run algorithm `algo` on HILDA and write causal graph to pickle."""
     print("Running %s algorithm." % algo)
-    g = algos[algo].predict(hilda1k)
+    g = algos[algo].predict(dataset('hilda1k'))
     pname = "graph-" + algo + "-hilda100" + ".pickle"
     with open(pname, "wb") as f:
         print("Writing output of %s to %s." % (algo, pname))
@@ -58,7 +57,7 @@ def run_algo_on_candidates(algo):
         cs = pickle.load(f1)
     candidates = cs + bcols
     print("Running %s algorithm." % algo)
-    g = algos[algo].predict(hilda1k[candidates])
+    g = algos[algo].predict(dataset('hilda1k')[candidates])
     pname = "graph-" + algo + "-hilda100" + ".pickle"
     with open(pname, "wb") as f2:
         print("Writing output of %s to %s." % (algo, pname))
@@ -74,6 +73,7 @@ def load_analysis():
                "future-of-work/analysis-hilda/"
                "graph-GIES-hilda100-tjbmsall.pickle", "rb") as f:
         h = pickle.load(f)
+    meta = dataset('meta')
     dg = { col: meta.column_names_to_labels[col] for col in g.nodes() }
     dh = { col: meta.column_names_to_labels[col] for col in h.nodes() }
     gplint(nx.relabel_nodes(causes(g, 'tjbmsall'), dg))
@@ -104,7 +104,9 @@ def run_isco(algo='GIES', isco=None):
             pickle.dump(g, f)
         return g
 
-def run_stratified(algo='GIES', iscos=iscover100):
+def run_stratified(algo='GIES', iscos=None):
+    # Default to all ISCO codes with enough rows.
+    if iscos is None: iscos = dataset('iscover100')
     # Prepare a dictionary for the causal graphs.
     d = {}
     # It is okay to pass a single code not wrapped in a list.
@@ -116,13 +118,19 @@ def run_stratified(algo='GIES', iscos=iscover100):
     with open("graphs-by-isco-dict.pickle", "wb") as f: pickle.dump(d, f)
     return d
 
-def run_stratified_parallel(algo='GIES', iscos=iscover100):
+def run_stratified_parallel(algo='GIES', iscos=None):
+    # Default to all ISCO codes with enough rows.
+    if iscos is None: iscos = dataset('iscover100')
+    # Load what the workers need up front, so they inherit it.
+    dataset('hilda')
+    dataset('strata')
     # Set up the multiprocessing facilities.
-    pool = multiprocessing.Pool()
-    # Collect the multiprocessing pre-results.
-    d = { isco: pool.apply_async(run_isco, (algo, isco)) for isco in iscos }
-    # Then extract the actual causal graphs and return them.
-    return { isco: d[isco].get() for isco in iscos }
+    with multiprocessing.Pool() as pool:
+        # Collect the multiprocessing pre-results.
+        d = { isco: pool.apply_async(run_isco, (algo, isco))
+              for isco in iscos }
+        # Then extract the actual causal graphs and return them.
+        return { isco: d[isco].get() for isco in iscos }
 
 def run_isco_colsampled(algo='GIES', isco=None, ncols=10, niters=10):
     if isco is None:
@@ -150,14 +158,25 @@ def collapsed_graph( data # Sub-set of hilda data.
                    , algos = ['PC', 'GES'] # List of algorithms to use.
                    , probability = .6 # Likelihood of existence of edge.
                    , iterations = 100 # How many times to sample in MC process.
+                   , halfwidth = None # Sample adaptively to this CI half-width.
                    ):
+    concepts = dataset('concepts')
     # Get the intersection of the causal graphs from the list algorithms.
-    g = discover(algos, data[c2h.variable.to_list()], intersected=True)
+    variables = dataset('c2h').variable.to_list()
+    g = discover(algos, data[variables], intersected=True)
     # Compute edge list with MC probabilities for collapsed graph.
-    A = [ (c1, c2, mcprob( g
-                         , concepts[c1], concepts[c2]
-                         , probability=.6, iterations=100 ))
-          for c1 in concepts for c2 in concepts if c1 != c2 ]
+    if halfwidth is None:
+        # All pairs of concepts from a single pass over the samples.
+        probs = mcprobs(g, concepts, probability, iterations)
+        A = [ (c1, c2, p) for (c1, c2), p in probs.items() ]
+    else:
+        # Stop sampling a pair as soon as its probability is known well enough.
+        A = [ (c1, c2, mcprob_adaptive( g
+                                      , concepts[c1], concepts[c2]
+                                      , probability=probability
+                                      , halfwidth=halfwidth
+                                      , maxiterations=iterations )[0])
+              for c1 in concepts for c2 in concepts if c1 != c2 ]
     # Prepare an empty directed graph.
     dg = nx.DiGraph()
     # Add the edges from the edge list.
@@ -165,98 +184,144 @@ def collapsed_graph( data # Sub-set of hilda data.
     # Deliver.
     return dg
 
-combinations = { 'sex': [ "any", "male", "female" ]
-               , 'age': [ "any"
-                        , "0-9"
-                        , "10-19"
-                        , "20-29"
-                        , "30-39"
-                        , "40-49"
-                        , "50-59"
-                        , "60-69"
-                        , "70-79"
-                        , "80-89"
-                        , "90-99"
-                        , "100-110" ]
-                , 'isco': ["any"] + iscover100
-                , 'education': ["any"] + [i for i in range(1, 11)]
-                , 'seifa': ["any"] +[i for i in range(1, 11)]
-                }
+def combinations():
+    """Return the values to stratify HILDA on, by stratum."""
+    return { 'sex': [ "any", "male", "female" ]
+           , 'age': [ "any"
+                    , "0-9"
+                    , "10-19"
+                    , "20-29"
+                    , "30-39"
+                    , "40-49"
+                    , "50-59"
+                    , "60-69"
+                    , "70-79"
+                    , "80-89"
+                    , "90-99"
+                    , "100+" ]
+            , 'isco': ["any"] + dataset('iscover100')
+            , 'education': ["any"] + [i for i in range(1, 11)]
+            , 'seifa': ["any"] +[i for i in range(1, 11)]
+            }
 
-def subsethilda( sex = "any"
+def stratumrows( sex = "any"
                , age = "any"
                , isco = "any"
                , education = "any"
                , seifa = "any" ):
-    # ISCO first and making sure none of this is destructive.
+    """Return sorted positions of rows of HILDA in the stratum asked for."""
+    # Strata are looked up in the index.
+    index = dataset('strata')
+    nothing = np.array([], dtype=int)
+    rowsets = []
+    # ISCO first.
     if isco == "any":
-        h = copy.deepcopy(hilda)
-    elif isco in iscover100:
-        h = copy.deepcopy(hilda_by_isco(isco))
+        pass
+    elif isco in dataset('iscover100'):
+        rowsets.append(index.get(('isco', isco), nothing))
     else:
         print("Error: wrong isco key.")
     # Filter on 'sex'.
     if sex == "any":
         pass
-    elif sex == 'male':
-        h = h[h['uhgsex'] == 1]
-    elif sex == 'female':
-        h = h[h['uhgsex'] == 2]
+    elif sex in ['male', 'female']:
+        rowsets.append(index['sex', sex])
     else:
         print("Error: wrong sex key.")
     # Filter on 'age'.
     if age == "any":
         pass
-    elif age == "0-9":
-        h = h[h[concepts['age'][0]].between(0, 10, inclusive='left')]
-    elif age == "10-19":
-        h = h[h[concepts['age'][0]].between(10, 20, inclusive='left')]
-    elif age == "20-29":
-        h = h[h[concepts['age'][0]].between(20, 30, inclusive='left')]
-    elif age == "30-39":
-        h = h[h[concepts['age'][0]].between(30, 40, inclusive='left')]
-    elif age == "40-49":
-        h = h[h[concepts['age'][0]].between(40, 50, inclusive='left')]
-    elif age == "50-59":
-        h = h[h[concepts['age'][0]].between(50, 60, inclusive='left')]
-    elif age == "60-69":
-        h = h[h[concepts['age'][0]].between(60, 70, inclusive='left')]
-    elif age == "70-79":
-        h = h[h[concepts['age'][0]].between(70, 80, inclusive='left')]
-    elif age == "80-89":
-        h = h[h[concepts['age'][0]].between(80, 90, inclusive='left')]
-    elif age == "90-99":
-        h = h[h[concepts['age'][0]].between(90, 100, inclusive='left')]
-    elif age == "100+":
-        h = h[h[concepts['age'][0]] >= 100]
+    elif age in [ "0-9", "10-19", "20-29", "30-39", "40-49"
+                , "50-59", "60-69", "70-79", "80-89", "90-99", "100+" ]:
+        rowsets.append(index['age', age])
     else:
         print("Error: wrong age key.")
     # Filter on 'education'.
     if education == "any":
         pass
     elif education in [i for i in range(1, 11)]:
-        h = h[ h[concepts['education'][0]] == education ]
+        rowsets.append(index.get(('education', education), nothing))
     else:
         print("Error: wrong education key.")
     # Filter on 'seifa'.
     if seifa == "any":
         pass
     elif seifa in [i for i in range(1, 11)]:
-        h = h[ h[concepts['seifa'][0]] == seifa ]
+        rowsets.append(index.get(('seifa', seifa), nothing))
     else:
         print("Error: wrong seifa key.")
     # Deliver.
-    return h
+    return intersectrows(rowsets, dataset('hilda').shape[0])
+
+def subsethilda( sex = "any"
+               , age = "any"
+               , isco = "any"
+               , education = "any"
+               , seifa = "any" ):
+    # Taking the rows is non-destructive.
+    rows = stratumrows(sex, age, isco, education, seifa)
+    return dataset('hilda').take(rows)
 
-graphkeys = [ (sex, age, isco, education, seifa)
-              for sex in combinations['sex']
-              for age in combinations['age']
-              for isco in combinations['isco']
-              for education in combinations['education']
-              for seifa in combinations['seifa'] ]
+def graphkeys():
+    """Return all combinations of strata as (sex, age, isco, edu, seifa)."""
+    c = combinations()
+    return [ (sex, age, isco, education, seifa)
+             for sex in c['sex']
+             for age in c['age']
+             for isco in c['isco']
+             for education in c['education']
+             for seifa in c['seifa'] ]
 
-def graphdict():
-    return { gk: collapsed_graph(subsethilda(*gk)) for gk in graphkeys }
+def graphfile(store, gk):
+    """Return path of the pickle of the graph of stratum `gk` in `store`."""
+    return os.path.join(store, "_".join(str(key) for key in gk) + ".pickle")
+
+def loadgraphs(store="graphs-by-strata"):
+    """Return dictionary of all stratum graphs in `store`, keyed by stratum."""
+    d = {}
+    for fname in sorted(os.listdir(store)):
+        if fname.endswith(".pickle"):
+            with open(os.path.join(store, fname), "rb") as f:
+                gk, g = pickle.load(f)
+            d[gk] = g
+    return d
+
+def stratumgraph(gk):
+    """Return stratum `gk` with its collapsed graph."""
+    return gk, collapsed_graph(subsethilda(*gk))
+
+def storegraphs(store, results, n):
+    # Store each graph as soon as it is done, so nothing is lost on a crash.
+    for i, (gk, g) in enumerate(results):
+        print("Storing graph %i of %i: %s." % (i+1, n, gk))
+        fname = graphfile(store, gk)
+        with open(fname + ".tmp", "wb") as f:
+            pickle.dump((gk, g), f)
+        os.replace(fname + ".tmp", fname)
+
+def graphdict( store="graphs-by-strata" # Directory to keep graphs in.
+             , minrows=100 # Skip strata with fewer rows than this.
+             , parallel=True # Whether to use a process pool.
+             , processes=None # Number of processes, `None` for all cores.
+             ):
+    """Compute collapsed graphs of all strata, resuming from `store`."""
+    os.makedirs(store, exist_ok=True)
+    # Skip strata done already or too small, before dispatching anything.
+    todo = [ gk for gk in graphkeys()
+             if not os.path.exists(graphfile(store, gk))
+             and len(stratumrows(*gk)) >= minrows ]
+    print("Computing graphs of %i strata." % len(todo))
+    # Load what the workers need up front, so they inherit it.
+    dataset('c2h')
+    dataset('concepts')
+    if parallel:
+        with multiprocessing.Pool(processes) as pool:
+            storegraphs(store, pool.imap_unordered(stratumgraph, todo),
+                        len(todo))
+    else:
+        storegraphs(store, map(stratumgraph, todo), len(todo))
+    # Deliver.
+    return loadgraphs(store)
 
 
 if __name__ == '__main__':
@@ -265,6 +330,7 @@ if __name__ == '__main__':
         print(args)
         if args[0] == 'blankets':
             # memory_limit()
+            hilda = dataset('hilda')
             bs = blankets(hilda, list(cols.keys()), parallel=False)
             # bs = blankets(hilda, list(cols.keys()), parallel=True)
             with open("blankets.pickle", "wb") as f: pickle.dump(bs, f)
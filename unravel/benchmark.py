@@ -6,10 +6,14 @@
 # Last modified: 2023-06-02
 #
 from unravel.causal import *
+from unravel.gtools import adjacencies
 
 
 import time
+import random
+import collections
 import multiprocessing
+from multiprocessing import shared_memory
 
 import cdt
 from cdt.data import AcyclicGraphGenerator as DAG
@@ -27,25 +31,18 @@ def errorcount(bs): return sum(errors(bs))
 
 def VHD(trial, truth, average=True):
     """Compute vertex-based hamming distances between `trial` and `truth`."""
-    # Prepare a vertex->score dictionary.
-    ds = {}
-    # Check each vertex.
-    for vertex in truth.nodes():
-        score = 0
-        # How many in-edges missed?
-        score += errorcount([ trial.has_edge(*edge)
-                              for edge in truth.in_edges(vertex) ])
-        # How many in-edges made up?
-        score += errorcount([ truth.has_edge(*edge)
-                              for edge in trial.in_edges(vertex) ])
-        # How many out-edges missed?
-        score += errorcount([ trial.has_edge(*edge)
-                              for edge in truth.out_edges(vertex) ])
-        # How many out-edges made up?
-        score += errorcount([ truth.has_edge(*edge)
-                              for edge in trial.out_edges(vertex) ])
-        # Provide the score as well as the true number of edges.
-        ds[vertex] = score, truth.degree(vertex)
+    # Adjacency matrices, the vertices of `truth` first.
+    vertices, (T, P) = adjacencies(truth, trial)
+    n = truth.number_of_nodes()
+    # In- and out-edges missed or made up are where the matrices differ.
+    D = T ^ P
+    scores = D.sum(axis=0) + D.sum(axis=1)
+    degrees = T.sum(axis=0) + T.sum(axis=1)
+    # Provide the score as well as the true number of edges, by vertex.
+    ds = { vertex: (score, degree)
+           for vertex, score, degree in zip( vertices[:n]
+                                           , scores[:n].tolist()
+                                           , degrees[:n].tolist() ) }
     # Deliver.
     if average:
         values = [ t[0] for t in ds.values() ]
@@ -55,23 +52,20 @@ def VHD(trial, truth, average=True):
 
 def precision(trial, truth, average=True):
     """Return fraction of true edges and all edges in `trial`, by vertex."""
-    # Prepare a vertex->score dictionary.
-    ds = {}
-    # Check each vertex.
-    for vertex in truth.nodes():
-        score = 0
-        # How many true in-edges?
-        score += sum([ trial.has_edge(*edge)
-                       for edge in truth.in_edges(vertex) ])
-        # How many true out-edges?
-        score += sum([ trial.has_edge(*edge)
-                       for edge in truth.out_edges(vertex) ])
-        # Compute the precision.
-        # TODO: Check the below --- trial.degree?!
-        # if score == 0 and trial.degree(vertex) == 0:
-            # ds[vertex] = 1.0
-        if trial.degree(vertex) > 0:
-            ds[vertex] = score / trial.degree(vertex)
+    # Adjacency matrices, the vertices of `truth` first.
+    vertices, (T, P) = adjacencies(truth, trial)
+    n = truth.number_of_nodes()
+    # How many true in- and out-edges?
+    TP = T & P
+    scores = TP.sum(axis=0) + TP.sum(axis=1)
+    degrees = P.sum(axis=0) + P.sum(axis=1)
+    # Compute the precision. Vertices without edges in `trial` are left out,
+    # unlike in `recall()`, where vertices without true edges count as 1.0.
+    ds = { vertex: score / degree
+           for vertex, score, degree in zip( vertices[:n]
+                                           , scores[:n].tolist()
+                                           , degrees[:n].tolist() )
+           if degree > 0 }
     # Deliver.
     if average:
         return sum(ds.values()) / len(ds)
@@ -80,22 +74,18 @@ def precision(trial, truth, average=True):
 
 def recall(trial, truth, average=True):
     """Return fraction of all true edges found in `trial`, by vertex."""
-    # Prepare a vertex->score dictionary.
-    ds = {}
-    # Check each vertex.
-    for vertex in truth.nodes():
-        score = 0
-        # How many true in-edges?
-        score += sum([ trial.has_edge(*edge)
-                       for edge in truth.in_edges(vertex) ])
-        # How many true out-edges?
-        score += sum([ trial.has_edge(*edge)
-                       for edge in truth.out_edges(vertex) ])
-        # Compute the recall.
-        if score == 0 and truth.degree(vertex) == 0:
-            ds[vertex] = 1.0
-        else:
-            ds[vertex] = score / truth.degree(vertex)
+    # Adjacency matrices, the vertices of `truth` first.
+    vertices, (T, P) = adjacencies(truth, trial)
+    n = truth.number_of_nodes()
+    # How many true in- and out-edges?
+    TP = T & P
+    scores = TP.sum(axis=0) + TP.sum(axis=1)
+    degrees = T.sum(axis=0) + T.sum(axis=1)
+    # Compute the recall.
+    ds = { vertex: 1.0 if score == 0 and degree == 0 else score / degree
+           for vertex, score, degree in zip( vertices[:n]
+                                           , scores[:n].tolist()
+                                           , degrees[:n].tolist() ) }
     # Deliver.
     if average:
         return sum(ds.values()) / len(ds)
@@ -114,6 +104,52 @@ def rel_edge_error(trial, truth):
                    )
     return average, stddev
 
+# The metrics computed by `benchmark()`.
+metrics = [ "precision", "recall", "VHD", "SHD", "SID" ]
+
+def iteration( algolist
+             , nvertices
+             , nrows
+             , mechanism='linear'
+             , noise='gaussian'
+             , chunksize=None
+             , target=None
+             , seed=None           # Seed for this iteration's randomness.
+             , penalty=-1000       # Precision/recall if `target` is missed.
+             , returndata=False
+             , i=0 ):              # Number of this iteration, for reporting.
+    """Compute the benchmark metrics once, on a freshly generated graph."""
+    # Seed every source of randomness the generator and discovery rely on.
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    # Generate the random causal network.
+    data, truth = generate( mechanism
+                          , noise=noise
+                          , nvertices=nvertices
+                          , nrows=nrows)
+    print("Discovering causal graphs for iteration %i." % (i+1))
+    trial = discover(algolist, data, chunksize, target)
+    # Calculate the statistics.
+    scores = {}
+    if target is None:
+        scores["precision"] = precision(trial, truth)
+        scores["recall"] = recall(trial, truth)
+    else:
+        prc_dict = precision(trial, truth, average=False)
+        scores["precision"] = prc_dict.get(target, penalty)
+        rec_dict = recall(trial, truth, average=False)
+        scores["recall"] = rec_dict.get(target, penalty)
+    scores["VHD"] = VHD(trial, truth)
+    scores["SHD"] = SHD(trial, truth)
+    scores["SID"] = SID(trial, truth)
+    # Archive the graph and data if asked.
+    if returndata:
+        scores["truth"] = truth
+        scores["trial"] = trial
+        scores["data"] = data
+    return scores
+
 def benchmark( algolist            # The list (strings) of algorithms to use.
              , nvertices           # How many vertices in the generated graphs.
              , nrows               # How many rows of generated data.
@@ -122,63 +158,92 @@ def benchmark( algolist            # The list (strings) of algorithms to use.
              , noise='gaussian'    # Distribution of the noise to use.
              , chunksize=None      # Partition column set in chunks this size.
              , target=None         # Focus on this variable.
-             , returndata=False ): # Also return truth/trial graphs and data.
+             , returndata=False    # Also return truth/trial graphs and data.
+             , seed=None           # Seed to derive iteration seeds from.
+             , parallel=False      # Run the iterations in a process pool.
+             , processes=None ):   # Number of processes, `None` for all cores.
     """Compute a suite of benchmarks."""
     # Prepare a metric->score dictionary.
     benchmarks = {}
-    # Initialise variables.
-    prc =  rec = vhd = shd = sid = 0.0
-    # Prepare empty lists for graphs and datasets.
-    truths = []
-    datas = []
-    trials = []
+    # Give each iteration its own seed, reproducibly so if `seed` is given.
+    seeds = [ int(s) for s in
+              np.random.SeedSequence(seed).generate_state(iterations) ]
+    # TODO: Deal more elegantly with a missed target.
+    args = [ ( algolist, nvertices, nrows, mechanism, noise, chunksize, target
+             , seeds[i], -1000*iterations, returndata, i )
+             for i in range(iterations) ]
     # Iterate to get credible statistics.
-    for i in range(iterations):
-        # Generate the random causal network.
-        data, truth = generate( mechanism
-                              , noise=noise
-                              , nvertices=nvertices
-                              , nrows=nrows)
-        j = i+1
-        print("Discovering causal graphs for iteration %i." % j)
-        trial = discover(algolist, data, chunksize, target)
-        # Archive the graph and data if asked.
-        if returndata:
-            truths.append(truth)
-            trials.append(trial)
-            datas.append(data)
-        # Calculate the statistics.
-        if target is None:
-            prc += precision(trial, truth)
-            rec += recall(trial, truth)
-        else:
-            prc_dict = precision(trial, truth, average=False)
-            if target in prc_dict:
-                prc += prc_dict[target]
-            else:
-                prc -= 1000*iterations # TODO: Deal more elegantly with this.
-            rec_dict = recall(trial, truth, average=False)
-            if target in rec_dict:
-                rec += rec_dict[target]
-            else:
-                rec -= 1000*iterations # TODO: Deal more elegantly with this.
-        vhd += VHD(trial, truth)
-        shd += SHD(trial, truth)
-        sid += SID(trial, truth)
-    # Do the averaging.
-    benchmarks["precision"] = prc / iterations
-    benchmarks["recall"] = rec / iterations
-    benchmarks["VHD"] = vhd / iterations
-    benchmarks["SHD"] = shd / iterations
-    benchmarks["SID"] = sid / iterations
+    if parallel:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(iteration, args)
+    else:
+        results = [ iteration(*arg) for arg in args ]
+    # Do the averaging, keeping the values of each iteration as well.
+    benchmarks["values"] = {}
+    benchmarks["variances"] = {}
+    for metric in metrics:
+        values = [ result[metric] for result in results ]
+        benchmarks[metric] = sum(values) / iterations
+        benchmarks["values"][metric] = values
+        benchmarks["variances"][metric] = np.var(values)
+    benchmarks["seeds"] = seeds
     if returndata:
-        benchmarks["truths"] = truths
-        benchmarks["trials"] = trials
-        benchmarks["datas"] = datas
+        benchmarks["truths"] = [ result["truth"] for result in results ]
+        benchmarks["trials"] = [ result["trial"] for result in results ]
+        benchmarks["datas"] = [ result["data"] for result in results ]
     # Deliver.
     return benchmarks
 
-def discover(algolist, data, chunksize=None, target=None, intersected=True):
+def share(data):
+    """Copy `data` to shared memory. Return the segment and its description."""
+    block = data.to_numpy(dtype='float64')
+    shm = shared_memory.SharedMemory(create=True, size=max(block.nbytes, 1))
+    np.ndarray(block.shape, dtype=block.dtype, buffer=shm.buf)[:] = block
+    return shm, (shm.name, block.shape, list(data.columns))
+
+def attach(spec, columns, rows=None):
+    """Return data frame of `columns` of shared data described by `spec`."""
+    name, shape, allcolumns = spec
+    shm = shared_memory.SharedMemory(name=name)
+    block = np.ndarray(shape, dtype='float64', buffer=shm.buf)
+    positions = [ allcolumns.index(col) for col in columns ]
+    if rows is None:
+        rows = np.arange(shape[0])
+    # Fancy indexing copies, so the segment can be let go of straight away.
+    data = pd.DataFrame(block[np.ix_(rows, positions)], columns=columns)
+    del block
+    shm.close()
+    return data
+
+def predictchunk(algo, spec, chunk):
+    """Run `algo` on the `chunk` of columns of the shared data in `spec`."""
+    return algos[algo].predict(attach(spec, chunk))
+
+def discoverchunks(chunkings, data, processes=None):
+    """Return algo => graphs of the chunks in `chunkings`, in parallel."""
+    # Workers read their chunks from shared memory rather than get a copy each.
+    shm, spec = share(data)
+    tasks = [ (algo, spec, chunk) for (algo, chunks) in chunkings.items()
+                                  for chunk in chunks ]
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            graphs = pool.starmap(predictchunk, tasks)
+    finally:
+        shm.close()
+        shm.unlink()
+    # Hand the graphs back to their algorithms, in the order of the chunks.
+    graphs = iter(graphs)
+    return { algo: [ next(graphs) for chunk in chunks ]
+             for (algo, chunks) in chunkings.items() }
+
+def discover( algolist
+            , data
+            , chunksize=None
+            , target=None
+            , intersected=True
+            , parallel=False # Discover chunks in a process pool.
+            , processes=None # Number of processes, `None` for all cores.
+            ):
     # In case just one algo is passed, put it in a list anyway.
     if type(algolist) == str: algolist = [algolist]
     # Prepare an empty list to hold the discovered causal graphs' edges.
@@ -195,6 +260,20 @@ def discover(algolist, data, chunksize=None, target=None, intersected=True):
             edgesets.append(graph.edges)
             # Add the graph to the dictionary.
             graphs[algo] = graph
+    elif parallel:
+        # Partition the columns for each algorithm and discover all at once.
+        chunkings = {}
+        for algo in algolist:
+            print("Running %s algorithm in chunks of %i." % ( algo
+                                                            , chunksize))
+            chunkings[algo] = partrand(data.columns, chunksize, var=target)
+        chunkgraphs = discoverchunks(chunkings, data, processes)
+        for algo in algolist:
+            graph = nx.compose_all(chunkgraphs[algo])
+            # Add the edgeset of the discovered graph to the list.
+            edgesets.append(graph.edges)
+            # Add the graph to the dictionary.
+            graphs[algo] = graph
     else:
         # Add causal graphs returned by each algorithm.
         for algo in algolist:
@@ -220,6 +299,91 @@ def discover(algolist, data, chunksize=None, target=None, intersected=True):
     else:
         return graphs
 
+def resample(algolist, spec, rows, columns):
+    """Return edges `algolist` agree on for `rows`, `columns` of shared data."""
+    return list(discover(algolist, attach(spec, columns, rows)).edges)
+
+def bootstrap( algolist            # The list (strings) of algorithms to use.
+             , data                # Data frame to resample.
+             , resamples=100       # Number of resamples, at most.
+             , ncols=None          # Subsample this many columns as well.
+             , target=None         # Keep this column in every subsample.
+             , batchsize=10        # Resamples between stability checks.
+             , tolerance=.01       # Stop if no frequency moves more than this.
+             , seed=None           # Seed for the resampling.
+             , parallel=True       # Run the resamples in a process pool.
+             , processes=None ):   # Number of processes, `None` for all cores.
+    """Return graph weighted by edge frequencies over bootstrap resamples."""
+    # In case just one algo is passed, put it in a list anyway.
+    if type(algolist) == str: algolist = [algolist]
+    rng = np.random.default_rng(seed)
+    columns = list(data.columns)
+    index = { col: i for i, col in enumerate(columns) }
+    # Which columns were in which resample and how often edges were found.
+    included = np.zeros((0, len(columns)), dtype=bool)
+    counts = collections.Counter()
+    frequencies = {}
+    if parallel:
+        shm, spec = share(data)
+        pool = multiprocessing.Pool(processes)
+    try:
+        while included.shape[0] < resamples:
+            n = min(batchsize, resamples - included.shape[0])
+            print( "Bootstrap resamples %i to %i."
+                 % (included.shape[0] + 1, included.shape[0] + n) )
+            tasks = []
+            for _ in range(n):
+                rows = rng.integers(0, data.shape[0], size=data.shape[0])
+                if ncols is None or ncols >= len(columns):
+                    cols = columns
+                else:
+                    others = [ col for col in columns if col != target ]
+                    ncol = ncols - (target in index)
+                    cols = list(rng.choice(others, ncol, replace=False))
+                    if target in index: cols.append(target)
+                tasks.append((rows, cols))
+            if parallel:
+                edgelists = pool.starmap( resample
+                                        , [ (algolist, spec, rows, cols)
+                                            for (rows, cols) in tasks ] )
+            else:
+                edgelists = [ list(discover( algolist
+                                           , data.iloc[rows][cols]
+                                             .reset_index(drop=True) ).edges)
+                              for (rows, cols) in tasks ]
+            batch = np.zeros((n, len(columns)), dtype=bool)
+            for i, (rows, cols) in enumerate(tasks):
+                batch[i, [ index[col] for col in cols ]] = True
+            included = np.concatenate([included, batch])
+            for edges in edgelists:
+                counts.update(edges)
+            # An edge can only be found when both its ends were sampled.
+            previous = frequencies
+            frequencies = { (u, v): count / np.sum( included[:, index[u]]
+                                                  & included[:, index[v]] )
+                            for (u, v), count in counts.items() }
+            change = max( [ abs(f - previous.get(edge, 0.0))
+                            for edge, f in frequencies.items() ]
+                        + [ f for edge, f in previous.items()
+                            if edge not in frequencies ]
+                        , default=0.0 )
+            if previous and change < tolerance:
+                print("Edge frequencies stable after %i resamples."
+                      % included.shape[0])
+                break
+    finally:
+        if parallel:
+            pool.close()
+            pool.join()
+            shm.close()
+            shm.unlink()
+    # Weighted graph, ready for `mcprob`, `reliability` or `merge_ugraphs`.
+    graph = nx.DiGraph()
+    graph.add_nodes_from(columns)
+    graph.add_weighted_edges_from([ (u, v, float(f))
+                                    for (u, v), f in frequencies.items() ])
+    return graph
+
 def generate( mechanism='linear'
             , noise='gaussian'
             , nvertices=nvertices
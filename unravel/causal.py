@@ -7,10 +7,10 @@
 # Last modified: 2023-05-21
 #
 
-import pickle, os, multiprocessing, copy, random
+import pickle, os, multiprocessing, copy, random, hashlib, collections
+import itertools
 
 import cdt
-from cdt.metrics import SHD, SID
 
 from pyCausalFS.CBD.MBs.HITON.HITON_MB import HITON_MB
 
@@ -18,12 +18,125 @@ import networkx as nx
 import pandas as pd
 import numpy as np
 
-from .gtools import markov_blanket
+from .gtools import markov_blanket, adjacencies
 
 glasso = cdt.independence.graph.Glasso()
 
-# Make sure SID returns an integer.
-def SID(target, prediction): return int(cdt.metrics.SID(target, prediction))
+# Make sure SID returns an integer. This one goes through R, see `SID()`.
+def RSID(target, prediction): return int(cdt.metrics.SID(target, prediction))
+
+def aligned(target, *predictions):
+    """Return adjacency matrices of `target` and `predictions`, aligned."""
+    # Like `cdt.metrics`, only the vertices of `target` count.
+    n = target.number_of_nodes()
+    vertices, matrices = adjacencies(target, *predictions)
+    return [ A[:n, :n] for A in matrices ]
+
+def SHD(target, prediction, double_for_anticausal=True):
+    """Return structural Hamming distance, as `cdt.metrics.SHD` would."""
+    return SHDs(target, [prediction], double_for_anticausal)[0]
+
+def SHDs(target, predictions, double_for_anticausal=True):
+    """Return structural Hamming distances of `predictions` to `target`."""
+    T, *Ps = aligned(target, *predictions)
+    if not Ps: return []
+    D = T ^ np.stack(Ps)
+    if double_for_anticausal:
+        return D.sum(axis=(1, 2)).tolist()
+    else:
+        # Count reversed edges only once.
+        return ((D | D.transpose(0, 2, 1)).sum(axis=(1, 2)) / 2).tolist()
+
+def closure(A):
+    """Return the reflexive transitive closure of adjacency matrix `A`."""
+    R = A | np.eye(A.shape[0], dtype=bool)
+    # Square until nothing new is reachable.
+    while True:
+        F = R.astype(np.float32)
+        S = (F @ F) > 0
+        if (S == R).all():
+            return R
+        R = S
+
+def dconnected(A, source, Z, ancestors):
+    """Return mask of vertices d-connected to `source` given `Z` in `A`."""
+    # Bayes-ball, vertex masks reached going up (to parents) and down.
+    seenup = np.zeros(A.shape[0], dtype=bool)
+    seendown = np.zeros(A.shape[0], dtype=bool)
+    up = A[:, source].copy()
+    down = A[source].copy()
+    while up.any() or down.any():
+        seenup |= up
+        seendown |= down
+        # Non-colliders pass the ball unless in `Z`, colliders only if they
+        # or one of their descendants are, i.e. if they are among `ancestors`.
+        passup = up & ~Z
+        passdown = down & ~Z
+        collide = down & ancestors
+        up = A[:, passup | collide].any(axis=1) & ~seenup
+        down = A[passup | passdown].any(axis=0) & ~seendown
+    return (seenup | seendown) & ~Z
+
+def sidwrong(G, R, i, pa):
+    """Return mask of `j` with effect of `i` wrong when adjusting for `pa`."""
+    n = G.shape[0]
+    descendants = R[i] & ~(np.arange(n) == i)
+    ancestors = R[:, pa].any(axis=1)
+    # A parent in `H` cannot be a descendant in `G` --- no effect claimed.
+    wrong = pa & descendants
+    # No parent may descend from a vertex on a causal path from `i`.
+    bad = R[descendants & ancestors].any(axis=0)
+    # And the parents must d-separate `i` and `j` in `G` without the
+    # first edges of causal paths from `i` to `j`. Vertices `j` cutting
+    # the same edges share the graph.
+    todo = ~pa & ~bad
+    todo[i] = False
+    cut = G[i][:, None] & R
+    groups = {}
+    for j in np.flatnonzero(todo):
+        groups.setdefault(cut[:, j].tobytes(), []).append(j)
+    for js in groups.values():
+        Gcut = G.copy()
+        Gcut[i] &= ~cut[:, js[0]]
+        bad[js] |= dconnected(Gcut, i, pa, ancestors)[js]
+    wrong |= ~pa & bad
+    wrong[i] = False
+    return wrong
+
+def sidcount(G, R, H):
+    """Return SID of `H` to `G`, given reflexive transitive closure `R`."""
+    # Undirected edges, as in CPDAGs, show up both ways in `H`.
+    undirected = H & H.T
+    count = 0
+    for i in range(G.shape[0]):
+        # Adjusting for the parents of `i` in `H` must give the right effect.
+        certain = H[:, i] & ~undirected[:, i]
+        possible = np.flatnonzero(undirected[:, i])
+        # Like R's `structIntervDist`, any neighbours along undirected edges
+        # may be parents too, so long as they form no new v-structure, i.e.
+        # are all adjacent. An effect is wrong if wrong for any such choice.
+        wrong = np.zeros(G.shape[0], dtype=bool)
+        for k in range(len(possible) + 1):
+            for chosen in itertools.combinations(possible, k):
+                chosen = list(chosen)
+                clique = undirected[np.ix_(chosen, chosen)]
+                if (clique | np.eye(k, dtype=bool)).all():
+                    pa = certain.copy()
+                    pa[chosen] = True
+                    wrong |= sidwrong(G, R, i, pa)
+        count += int(wrong.sum())
+    return count
+
+def SID(target, prediction):
+    """Return structural intervention distance, without going through R."""
+    return SIDs(target, [prediction])[0]
+
+def SIDs(target, predictions):
+    """Return structural intervention distances of `predictions` to `target`."""
+    G, *Hs = aligned(target, *predictions)
+    # The reachability in `target` is shared by all predictions.
+    R = closure(G)
+    return [ sidcount(G, R, H) for H in Hs ]
 
 # Instantiate pairwise algorithm.
 anm = cdt.causality.pairwise.ANM()
@@ -37,7 +150,114 @@ algorithms = [ cdt.causality.graph.CAM()
              , cdt.causality.graph.PC()
              , cdt.causality.graph.SAM()
              , cdt.causality.graph.SAMv1() ]
-algos = { str(algo).split(sep='.')[3]: algo for algo in algorithms }
+
+# Where to keep discovered causal graphs across sessions, `None` for nowhere.
+# Off by default, set to e.g. `~/.cache/unravel/graphs` to switch it on.
+graphcache_path = None
+# How many discovered causal graphs each algorithm keeps in memory.
+graphcache_size = 128
+# How many discovered causal graphs to keep on disk, least recently used go.
+graphcache_disksize = 1024
+# Algorithms that need not give the same graph twice, so are never cached.
+stochastic = { 'CAM', 'SAM', 'SAMv1' }
+
+def datahash(data):
+    """Return hash of the values and the column order of data frame `data`."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pickle.dumps([ str(col) for col in data.columns ]))
+    h.update(pd.util.hash_pandas_object(data, index=False).to_numpy())
+    return h.hexdigest()
+
+def hyperparameters(algo):
+    """Return the simply typed attributes of `algo`, as a sorted list."""
+    simple = (str, int, float, bool, type(None))
+    def issimple(val):
+        if isinstance(val, (list, tuple)):
+            return all(issimple(v) for v in val)
+        else:
+            return isinstance(val, simple)
+    return sorted( (key, val) for (key, val) in vars(algo).items()
+                              if issimple(val) )
+
+class CachedAlgorithm:
+    """Causal discovery algorithm that remembers what it discovered before."""
+    # Graphs are keyed on a hash of the data, its column order, the name of the
+    # algorithm and its hyperparameters. The most recently used ones are kept
+    # in memory and, if `graphcache_path` is set, on disk.
+    def __init__(self, name, algorithm):
+        self.name = name
+        self.algorithm = algorithm
+        self.graphs = collections.OrderedDict()
+
+    def __getattr__(self, attribute):
+        # Anything not about caching is the wrapped algorithm's business.
+        if attribute == 'algorithm':
+            raise AttributeError(attribute)
+        return getattr(self.algorithm, attribute)
+
+    def __repr__(self):
+        return repr(self.algorithm)
+
+    def key(self, data):
+        """Return the cache key for running this algorithm on `data`."""
+        h = hashlib.blake2b(digest_size=16)
+        h.update(pickle.dumps((self.name, hyperparameters(self.algorithm))))
+        h.update(datahash(data).encode())
+        return self.name + '-' + h.hexdigest()
+
+    def predict(self, data, *args, **kwargs):
+        """Return causal graph of `data`, from the cache if possible."""
+        # Only plain calls on data frames are cached, of deterministic ones.
+        if ( args or kwargs or not isinstance(data, pd.DataFrame)
+             or self.name in stochastic ):
+            return self.algorithm.predict(data, *args, **kwargs)
+        key = self.key(data)
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+        else:
+            self.graphs[key] = self.load(key, data)
+            if len(self.graphs) > graphcache_size:
+                self.graphs.popitem(last=False)
+        # Hand out a copy, so callers cannot mess up the cache.
+        return self.graphs[key].copy()
+
+    def load(self, key, data):
+        """Return graph under `key` from disk, discovering it if not there."""
+        if graphcache_path is None:
+            return self.algorithm.predict(data)
+        fname = os.path.join(graphcache_path, key + ".pickle")
+        if os.path.exists(fname):
+            # Mark it as used, for the eviction.
+            os.utime(fname)
+            with open(fname, "rb") as f:
+                return pickle.load(f)
+        graph = self.algorithm.predict(data)
+        os.makedirs(graphcache_path, exist_ok=True)
+        with open(fname + ".%i.tmp" % os.getpid(), "wb") as f:
+            pickle.dump(graph, f)
+        os.replace(fname + ".%i.tmp" % os.getpid(), fname)
+        evict()
+        return graph
+
+def evict():
+    """Remove least recently used graphs beyond `graphcache_disksize`."""
+    fnames = [ entry for entry in os.scandir(graphcache_path)
+               if entry.name.endswith(".pickle") ]
+    if len(fnames) <= graphcache_disksize:
+        return
+    fnames.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in fnames[:len(fnames) - graphcache_disksize]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError: # Another process got there first.
+            pass
+
+def algoname(algo):
+    """Return the name of the algorithm, e.g. 'GES'."""
+    return str(algo).split(sep='.')[3]
+
+algos = { algoname(algo): CachedAlgorithm(algoname(algo), algo)
+          for algo in algorithms }
 nalgos = len(algos)
 
 def partrand(cs, n, var=None):
@@ -101,9 +321,12 @@ def distances(data, algos):
     shd_matrix = df.copy()
     sid_matrix = df.copy()
     for row in range(nalgos):
-        for col in range(nalgos):
-            shd_matrix.loc[algonames[row], algonames[col]]=SHD(gs[row], gs[col])
-            sid_matrix.loc[algonames[row], algonames[col]]=SID(gs[row], gs[col])
+        # SHD is symmetric, so only the diagonal and upper half are computed.
+        shds = SHDs(gs[row], gs[row:])
+        for col, shd in enumerate(shds, start=row):
+            shd_matrix.iloc[row, col] = shd_matrix.iloc[col, row] = shd
+        # SID is not, but all predictions share the reachability of the target.
+        sid_matrix.iloc[row] = SIDs(gs[row], gs)
     return shd_matrix, sid_matrix
 
 def blanket(data, var, algorithm=HITON_MB, alpha=.01):
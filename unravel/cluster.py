@@ -1,7 +1,9 @@
 from unravel import *
 
 import numpy as np
+import scipy.sparse
 import random
+import multiprocessing
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import FeatureAgglomeration
 from sklearn.cluster import DBSCAN
@@ -10,6 +12,18 @@ import matplotlib.pyplot as plt
 import stopwords
 import difflib
 import Levenshtein
+import hashlib
+import os
+import collections
+import functools
+import math
+
+# Where `cluster()` keeps label distance matrices, if asked to persist them.
+distance_path = os.path.join( os.path.expanduser("~")
+                            , ".cache", "unravel", "distances" )
+
+# Words `keywords()` leaves out, loaded once.
+excludedwords = frozenset(stopwords.get_stopwords('english') + ['-'])
 
 def histplot(data):
     plt.hist(data, bins=data.max())
@@ -21,6 +35,7 @@ def d(s1, s2):
                                       , s2.lower().split() ).ratio()
 
 def cull(data):
+    meta = dataset('meta')
     cols = data.columns.to_list()
     # Remove relationship grid columns: 57
     cs1 = {col for col in cols if 'urx' in col}
@@ -75,6 +90,7 @@ def cols_in_cluster( data # Data set (pandas dataframe)
                    , clustering # Clustering object.
                    , index # Index of cluster to find columns of.
                    ):
+    meta = dataset('meta')
     return [ meta.column_names_to_labels[col]
              for col in data.columns[np.where( clustering.labels_ == index
                                              , True
@@ -105,12 +121,12 @@ def text_in_cluster(data, clustering, index):
     return [ word.lower() for word in words if word.isalpha() ]
 
 def keywords(text, n=10, returndict=False):
-    excludedwords = stopwords.get_stopwords('english')
-    excludedwords.append('-')
+    # One pass over the text. Counts are of the words as they are in `text`.
+    counts = collections.Counter(text)
     uwords = sorted( { word.lower()
-                       for word in text
+                       for word in counts
                        if word.lower() not in excludedwords } )
-    d = dict( sorted( [ (word, text.count(word)) for word in uwords ]
+    d = dict( sorted( [ (word, counts[word]) for word in uwords ]
                     , key=lambda t: t[1]
                     , reverse=True ) )
     if returndict: return d
@@ -120,18 +136,216 @@ def clusterkeywords(data, clustering, index, n=10, returndict=False):
     return keywords( text_in_cluster(data, clustering, index)
                    , n=n, returndict=returndict )
 
-def dmatrix(labels):
-    A = np.zeros((len(labels), len(labels)))
-    for i in range(len(labels)):
-        for j in range(1+i, len(labels)):
-            A[i, j] = A[j, i] = d(labels[i], labels[j])
-    return A
+def keywords_by_cluster(data, clustering, n=10, returndict=False):
+    """Return cluster index => keywords, for all clusters in one go."""
+    meta = dataset('meta')
+    texts = collections.defaultdict(list)
+    for col, index in zip(data.columns, clustering.labels_):
+        words = meta.column_names_to_labels[col].split()
+        texts[index] += [ word.lower() for word in words if word.isalpha() ]
+    return { int(index): keywords(texts[index], n=n, returndict=returndict)
+             for index in np.unique(clustering.labels_) }
+
+def tokenise(labels):
+    """Return labels as tuples of integer word ids, words as `d()` has them."""
+    vocabulary = {}
+    return [ tuple( vocabulary.setdefault(word, len(vocabulary))
+                    for word in label.lower().split() )
+             for label in labels ]
+
+def dpairs(tokens, pairs):
+    """Return `d()` of the token tuples in `pairs`, grouped by second index."""
+    ds = np.empty(len(pairs))
+    s = difflib.SequenceMatcher(None)
+    j0 = None
+    for k, (i, j) in enumerate(pairs):
+        # The matcher indexes its second sequence, so reuse that if possible.
+        if j != j0:
+            s.set_seq2(tokens[j])
+            j0 = j
+        s.set_seq1(tokens[i])
+        ds[k] = 1 - s.ratio()
+    return ds
+
+def dbatch(tokens, pairs, parallel=True, processes=None):
+    """Return `d()` of the token tuples in `pairs`, in a pool if parallel."""
+    if not parallel or len(pairs) == 0:
+        return dpairs(tokens, pairs)
+    nchunks = 4 * (processes or multiprocessing.cpu_count())
+    chunks = np.array_split(pairs, nchunks)
+    with multiprocessing.Pool(processes) as pool:
+        ds = pool.starmap(dpairs, [ (tokens, chunk) for chunk in chunks ])
+    return np.concatenate(ds)
+
+def dcondensed(labels, dtype=np.float32, parallel=True, processes=None):
+    """Return condensed upper triangle of label distances, row by row."""
+    tokens = tokenise(labels)
+    n = len(tokens)
+    # Labels without a word in common are at distance one.
+    D = np.ones(n * (n - 1) // 2, dtype=dtype)
+    lengths = np.array([ len(t) for t in tokens ], dtype=int)
+    nwords = max((max(t) for t in tokens if t), default=-1) + 1
+    X = scipy.sparse.csr_matrix( ( np.ones(lengths.sum(), dtype=int)
+                                 , [ w for t in tokens for w in t ]
+                                 , np.concatenate([[0], lengths.cumsum()]) )
+                               , shape=(n, nwords) )
+    overlap = scipy.sparse.triu(X @ X.T, k=1).tocoo()
+    # Upper triangle only, ordered by column to reuse the matcher.
+    order = np.lexsort((overlap.row, overlap.col))
+    pairs = np.stack([overlap.row[order], overlap.col[order]], axis=1)
+    ds = dbatch(tokens, pairs, parallel, processes)
+    D[condensedindex(n, pairs[:, 0], pairs[:, 1])] = ds
+    # Two empty labels are the same, as far as `d()` is concerned.
+    empty = np.flatnonzero(lengths == 0)
+    i, j = np.triu_indices(len(empty), k=1)
+    D[condensedindex(n, empty[i], empty[j])] = 0
+    return D
+
+def condensedindex(n, i, j):
+    """Return position of entries `i` < `j` in a condensed `n` x `n` matrix."""
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+def block(D, n, indices):
+    """Return square matrix of `indices` out of condensed `n` x `n` matrix."""
+    indices = np.asarray(indices, dtype=np.int64)
+    B = np.zeros((len(indices), len(indices)), dtype=D.dtype)
+    # A row at a time, so no index arrays of the size of the block are needed.
+    for r, i in enumerate(indices):
+        lo = np.minimum(i, indices)
+        hi = np.maximum(i, indices)
+        off = lo != hi
+        B[r, off] = D[condensedindex(n, lo[off], hi[off])]
+    return B
+
+def dmatrix(labels, parallel=True, processes=None):
+    D = dcondensed(labels, np.float64, parallel, processes)
+    return block(D, len(labels), np.arange(len(labels)))
 
-def cluster(data):
+def labelhash(labels):
+    """Return hash of the labels, in order."""
+    h = hashlib.blake2b(digest_size=16)
+    for label in labels:
+        h.update(label.encode() + b"\0")
+    return h.hexdigest()
+
+def labeldistances(labels, persist=False, parallel=True, processes=None):
+    """Return condensed float32 label distances, memory-mapped if persisted."""
+    if not persist or distance_path is None:
+        return dcondensed(labels, np.float32, parallel, processes)
+    fname = os.path.join(distance_path, labelhash(labels) + ".npy")
+    if not os.path.exists(fname):
+        D = dcondensed(labels, np.float32, parallel, processes)
+        os.makedirs(distance_path, exist_ok=True)
+        with open(fname + ".%i.tmp" % os.getpid(), "wb") as f:
+            np.save(f, D)
+        os.replace(fname + ".%i.tmp" % os.getpid(), fname)
+    return np.load(fname, mmap_mode='r')
+
+def minhashes(tokens, nhashes=64, seed=0):
+    """Return MinHash signatures of the word sets of tokenised labels."""
+    rng = np.random.default_rng(seed)
+    # Universal hashing modulo the Mersenne prime 2^31 - 1.
+    prime = (1 << 31) - 1
+    a = rng.integers(1, prime, size=nhashes, dtype=np.int64)
+    b = rng.integers(0, prime, size=nhashes, dtype=np.int64)
+    lengths = np.array([ len(t) for t in tokens ], dtype=int)
+    words = np.array([ w for t in tokens for w in t ], dtype=np.int64)
+    hashes = (np.outer(words, a) + b) % prime
+    # Labels without words all get the same, otherwise impossible, signature.
+    signatures = np.full((len(tokens), nhashes), prime, dtype=np.int64)
+    nonempty = np.flatnonzero(lengths)
+    if nonempty.size > 0:
+        starts = np.concatenate([[0], lengths.cumsum()[:-1]])[nonempty]
+        signatures[nonempty] = np.minimum.reduceat(hashes, starts, axis=0)
+    return signatures
+
+def lshpairs(signatures, nbands=32):
+    """Return pairs `i` < `j` sharing all of some band of their signatures."""
+    n = signatures.shape[0]
+    keys = []
+    for band in np.array_split(signatures, nbands, axis=1):
+        buckets = np.unique(band, axis=0, return_inverse=True)[1].ravel()
+        order = np.argsort(buckets, kind='stable')
+        starts = np.flatnonzero(np.diff(buckets[order], prepend=-1))
+        for members in np.split(order, starts[1:]):
+            if len(members) > 1:
+                i, j = np.triu_indices(len(members), k=1)
+                keys.append(members[i] * n + members[j])
+    keys = np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=int)
+    return np.stack([keys // n, keys % n], axis=1)
+
+def sparsedistances( labels
+                   , radius=.5 # Keep only distances up to this.
+                   , nhashes=64 # Length of MinHash signatures.
+                   , nbands=32 # Number of LSH bands to split them in.
+                   , parallel=True
+                   , processes=None ):
+    """Return sparse matrix of label distances up to `radius`, via LSH."""
+    tokens = tokenise(labels)
+    n = len(tokens)
+    pairs = lshpairs(minhashes(tokens, nhashes), nbands)
+    # Ordered by column to reuse the matcher.
+    pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+    ds = dbatch(tokens, pairs, parallel, processes)
+    near = ds <= radius
+    pairs, ds = pairs[near], ds[near]
+    # Symmetric, with explicit zeros, the diagonal included, as neighbours.
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+    data = np.concatenate([ds, ds, np.zeros(n)]).astype(np.float32)
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+def padneighbours(S, k, distance=1.0):
+    """Return `S` with every row given `k` neighbours, padding at `distance`."""
+    n = S.shape[0]
+    S = S.tocoo()
+    counts = np.bincount(S.row, minlength=n)
+    k = min(k, n)
+    short = np.flatnonzero(counts < k)
+    if short.size == 0:
+        return S.tocsr()
+    # OPTICS needs `k` neighbours per point. Distance one is as far as `d()`
+    # goes, so padded neighbours are never nearer than they really are.
+    # Candidates are the next few vertices round, enough to skip those that
+    # are neighbours already.
+    m = min(k, n - 1)
+    rows = np.repeat(short, m)
+    cols = (rows + np.tile(np.arange(1, m + 1), short.size)) % n
+    present = np.sort(S.row.astype(np.int64) * n + S.col)
+    keys = rows * n + cols
+    positions = np.searchsorted(present, keys).clip(max=present.size - 1)
+    new = present[positions] != keys
+    rows, cols = rows[new], cols[new]
+    # Only as many as each row is short, taking the first ones.
+    rank = np.arange(rows.size) - np.searchsorted(rows, rows)
+    keep = rank < (k - counts)[rows]
+    rows, cols = rows[keep], cols[keep]
+    # Both ways round, to keep it symmetric.
+    keys = np.unique(np.concatenate([rows * n + cols, cols * n + rows]))
+    rows, cols = keys // n, keys % n
+    # Not `S + P`, as adding would drop the explicit zeros.
+    data = np.concatenate([S.data, np.full(len(rows), distance, S.dtype)])
+    return scipy.sparse.csr_matrix( ( data
+                                    , ( np.concatenate([S.row, rows])
+                                      , np.concatenate([S.col, cols]) ) )
+                                  , shape=S.shape )
+
+def cluster(data, persist=False, sparse=False, radius=.5):
+    meta = dataset('meta')
     labels = np.array( [ meta.column_names_to_labels[col]
                          for col in data.columns ] )
-    A = dmatrix(labels)
+    # Distances are computed once; sub-clusters are looked up in them.
+    if sparse:
+        # Near neighbours only, for label sets too big for a dense matrix.
+        S = sparsedistances(labels, radius)
+        submatrix = lambda indices: padneighbours(S[indices][:, indices], 2)
+        A = padneighbours(S, 5)
+    else:
+        D = labeldistances(labels, persist=persist)
+        submatrix = lambda indices: block(D, len(labels), indices)
+        A = submatrix(np.arange(len(labels)))
     clustering = OPTICS(metric='precomputed').fit(A)
+    del A
 
     clustersize = len(labels)
     iteration = 1
@@ -148,7 +362,7 @@ def cluster(data):
         print( "Recursively clustering largest cluster. Iteration: %i"
              % iteration)
         iteration += 1
-        B = dmatrix(labels[clustering.labels_ == clusterindex])
+        B = submatrix(np.flatnonzero(clustering.labels_ == clusterindex))
         clusteringB = OPTICS( min_samples=2
                             , metric='precomputed').fit(B)
         # If only one cluster is found, report and break loop.
@@ -180,33 +394,47 @@ def subset_from_clusters(data, clustering):
         vars.append(sample_var_from_cluster(data, clustering, i))
     return data[vars]
 
-def keyphrases(stringlist):
-    pairs = [ (s1.lower().split(), s2.lower().split()) for s1 in stringlist
-                                                       for s2 in stringlist
-                                                       if s1 != s2 ]
-    matches = []
-    for pair in pairs:
+def keyphrases(stringlist, maxpairs=10000, seed=0):
+    return list(cachedkeyphrases(tuple(stringlist), maxpairs, seed))
+
+@functools.lru_cache(maxsize=1024)
+def cachedkeyphrases(strings, maxpairs, seed):
+    """Return key phrases of `strings`, longest first, memoised per cluster."""
+    # Repeated strings add no phrases, so each string is tokenised just once.
+    words = [ s.lower().split() for s in dict.fromkeys(strings) ]
+    n = len(words)
+    npairs = n * (n - 1) // 2
+    # Each unordered pair once, ordered by second index to reuse the matcher.
+    if npairs <= maxpairs:
+        pairs = [ (i, j) for j in range(n) for i in range(j) ]
+    else:
+        # Too many, so a fixed sample of them.
+        sample = sorted(random.Random(seed).sample(range(npairs), maxpairs))
+        pairs = [ (k - j * (j - 1) // 2, j) for k in sample
+                  for j in [ (1 + math.isqrt(1 + 8 * k)) // 2 ] ]
+    matches = {} # Insertion ordered, so first-seen phrases come first.
+    s = difflib.SequenceMatcher(None)
+    j0 = None
+    for (i, j) in pairs:
+        if j != j0:
+            s.set_seq2(words[j])
+            j0 = j
+        s.set_seq1(words[i])
         # Distill the matching blocks of words.
-        s = difflib.SequenceMatcher(None, *pair)
         blocks = s.get_matching_blocks()[:-1] # '-1' to exclude trivial match.
-        matching = [ pair[0][block.a:block.a+block.size]
-                     for block in blocks ]
-        # Remove non-words.
-        matching = [ [ word for word in match if word.isalpha() ]
-                     for match in matching ]
-        # Concatenate words to phrases.
-        matching = [ " ".join(match) for match in matching ]
-        # Remove empty phrases.
-        matching = [ match for match in matching if match != '' ]
-        # Avoid repeating phrases across match-sets.
-        matching = [ match for match in matching if match not in matches ]
-        # Add to the list.
-        matches += matching
-    return sorted(matches, key=len, reverse=True)
+        for block in blocks:
+            match = words[i][block.a:block.a+block.size]
+            # Remove non-words and concatenate words to phrases.
+            match = " ".join(word for word in match if word.isalpha())
+            # Remove empty phrases and avoid repeating phrases.
+            if match != '':
+                matches.setdefault(match)
+    return tuple(sorted(matches, key=len, reverse=True))
 
 def keyphrase(stringlist):
-    if len(keyphrases(stringlist)) > 4:
-        return keyphrases(stringlist)[0]
+    phrases = keyphrases(stringlist)
+    if len(phrases) > 4:
+        return phrases[0]
     else:
         words = keywords(' '.join(stringlist).split())
         words = [ word for word in words if word.isalpha() ]
@@ -236,7 +464,7 @@ def discover_clustered( clustering
 
 
 if __name__ == "__main__":
-    h, _ = cull(hilda)
+    h, _ = cull(dataset('hilda'))
     h33, _ = cull(hilda_by_isco(33))
 
 
@@ -12,6 +12,13 @@ import numpy as np
 import math
 import random
 import copy
+import statistics
+import itertools
+import collections
+import time
+
+from scipy.stats import beta
+from scipy.sparse.csgraph import connected_components
 
 import matplotlib
 matplotlib.use('TkAgg')
@@ -30,119 +37,390 @@ def intersect(g1, g2):
     g.add_edges_from(edges)
     return g
 
+def adjacencies(*graphs):
+    """Return vertex list and aligned boolean adjacency matrices of `graphs`."""
+    # Vertices of the first graph come first, then any others, in order.
+    vertices = list(dict.fromkeys(v for g in graphs for v in g.nodes()))
+    index = { v: i for i, v in enumerate(vertices) }
+    matrices = []
+    for g in graphs:
+        A = np.zeros((len(vertices), len(vertices)), dtype=bool)
+        edges = np.array( [ (index[u], index[v]) for (u, v) in g.edges() ]
+                        , dtype=int ).reshape(-1, 2)
+        A[edges[:, 0], edges[:, 1]] = True
+        if not g.is_directed():
+            A |= A.T
+        matrices.append(A)
+    return vertices, matrices
+
+# Bytes a batch of Monte Carlo samples may take, roughly.
+mcmemory = 2**28
+
+def mcbatchsize(nvertices, nedges, nsets=1):
+    """Return how many samples fit in `mcmemory`, for `nsets` source sets."""
+    # Random keys, kept masks and deleted indices take some 24 bytes per edge
+    # and sample, the reachability bits of every source set an eighth of that
+    # per edge and vertex.
+    nbytes = 24 * nedges + (2 * nedges + 3 * nvertices) * nsets / 8
+    # Whole bytes of bits, and never so few samples that overhead dominates.
+    return max(8, int(mcmemory // max(nbytes, 1)) // 8 * 8)
+
+def edgearrays(graph, sources, sinks):
+    """Return number of vertices, edge arrays and source/sink indices."""
+    index = { v: i for i, v in enumerate(graph.nodes()) }
+    for v in sources + sinks:
+        if v not in index:
+            raise nx.NodeNotFound("Vertex %s not in graph." % v)
+    # Keep the edges in the order `graph.edges` has them.
+    edges = np.array( [ (index[u], index[v]) for (u, v) in graph.edges ]
+                    , dtype=int ).reshape(-1, 2)
+    return ( len(index), edges[:, 0], edges[:, 1]
+           , [ index[v] for v in sources ], [ index[v] for v in sinks ] )
+
+def deletion(graph, probability):
+    """Return how many edges to delete, or else the probability of each."""
+    if probability is None:
+        # Every edge is kept with the probability in its weight.
+        return np.array( [ weight(graph, edge) for edge in graph.edges ]
+                       , dtype=float )
+    # Compute how many edges need to be kept/deleted --- pessimistically.
+    return math.ceil((1 - probability) * graph.number_of_edges())
+
+def keptedges(nedges, ndelete, nsamples, rng):
+    """Return `nsamples` x `nedges` mask of edges kept, `ndelete` deleted."""
+    if isinstance(ndelete, np.ndarray):
+        # Edge probabilities rather than a number, so keep independently.
+        return rng.random((nsamples, nedges)) < ndelete
+    kept = np.ones((nsamples, nedges), dtype=bool)
+    if ndelete > 0:
+        # Deleting the edges with the smallest random keys samples uniformly.
+        keys = rng.random((nsamples, nedges), dtype=np.float32)
+        deleted = np.argpartition(keys, ndelete-1, axis=1)[:, :ndelete]
+        np.put_along_axis(kept, deleted, False, axis=1)
+    return kept
+
+def reaches(nvertices, tails, heads, kept, sources, sinks):
+    """Tell, by sample, whether any sink is reachable from any source."""
+    nsamples = kept.shape[0]
+    # Bit `s` of row `v` tells whether vertex `v` is reached in sample `s`.
+    reached = np.zeros((nvertices, (nsamples + 7) // 8), dtype=np.uint8)
+    reached[sources] = 0xFF
+    done = np.bitwise_or.reduce(reached[sinks], axis=0)
+    if len(tails) > 0:
+        # Edges by head, so incoming bits can be combined per vertex.
+        order = np.argsort(heads, kind='stable')
+        tails, heads = tails[order], heads[order]
+        alive = np.packbits(kept[:, order].T, axis=1)
+        targets, starts = np.unique(heads, return_index=True)
+        frontier = reached.copy()
+        # Breadth-first, all samples at once, until no sample gets further.
+        while frontier.any() and not (done == 0xFF).all():
+            pushed = frontier[tails] & alive & ~done
+            incoming = np.bitwise_or.reduceat(pushed, starts, axis=0)
+            new = incoming & ~reached[targets]
+            reached[targets] |= new
+            frontier[:] = 0
+            frontier[targets] = new
+            done |= np.bitwise_or.reduce(reached[sinks], axis=0)
+    return np.unpackbits(done, count=nsamples).astype(bool)
+
+def mcsample( arrays # Number of vertices, edge arrays, sources and sinks.
+            , ndelete # How many edges to delete, or edge probabilities.
+            , nsamples # How many samples.
+            , rng # NumPy random generator.
+            , batchsize=None # At most this many at a time, else by memory.
+            ):
+    """Tell, by sample, whether a path survives deleting `ndelete` edges."""
+    nvertices, tails, heads, sources, sinks = arrays
+    if batchsize is None:
+        batchsize = mcbatchsize(nvertices, len(tails))
+    hits = []
+    for start in range(0, nsamples, batchsize):
+        n = min(batchsize, nsamples - start)
+        kept = keptedges(len(tails), ndelete, n, rng)
+        hits.append(reaches(nvertices, tails, heads, kept, sources, sinks))
+    return np.concatenate(hits) if hits else np.zeros(0, dtype=bool)
+
 def mcprob( graph # Weighted directed network.
           , sources # Start vertices.
           , sinks # End vertices.
           , probability=None # Probability of edge presence.
           , iterations=100 # How many times to simulate.
+          , seed=None # Seed for the random deletions.
           ):
     # In case only one source or sink is provided, put them in a list anyway.
     if type(sources) != list: sources = [sources]
     if type(sinks) != list: sinks = [sinks]
-    # Compute how many edges need to be kept/deleted --- pessimistically.
-    mtodelete = math.ceil((1 - probability) * graph.number_of_edges())
+    mtodelete = deletion(graph, probability)
     # Calculate fraction of simulations that has a path from source to sink.
-    npaths = 0
-    for i in range(iterations):
-        g = nx.DiGraph(graph)
-        g.remove_edges_from(random.sample(list(g.edges), mtodelete))
-        paths = []
-        for source in sources:
-            for sink in sinks:
-                paths.append(nx.has_path(g, source, sink))
-        if any(paths):
-            npaths += 1
+    arrays = edgearrays(graph, sources, sinks)
+    rng = np.random.default_rng(seed)
+    npaths = int(mcsample(arrays, mtodelete, iterations, rng).sum())
     return npaths / iterations
 
+def reachedfrom(nvertices, tails, heads, kept, sourcesets):
+    """Return, by vertex and source set, packed bits of samples reaching it."""
+    nsamples = kept.shape[0]
+    nbytes = (nsamples + 7) // 8
+    # Source set `k` owns bytes `k*nbytes` up to `(k+1)*nbytes` of each row.
+    reached = np.zeros((nvertices, len(sourcesets) * nbytes), dtype=np.uint8)
+    for k, sources in enumerate(sourcesets):
+        reached[sources, k*nbytes:(k+1)*nbytes] = 0xFF
+    if len(tails) > 0:
+        # Edges by head, so incoming bits can be combined per vertex.
+        order = np.argsort(heads, kind='stable')
+        tails, heads = tails[order], heads[order]
+        alive = np.packbits(kept[:, order].T, axis=1)
+        alive = np.tile(alive, len(sourcesets))
+        targets, starts = np.unique(heads, return_index=True)
+        frontier = reached.copy()
+        # Breadth-first, all samples and source sets at once.
+        while frontier.any():
+            pushed = frontier[tails] & alive
+            incoming = np.bitwise_or.reduceat(pushed, starts, axis=0)
+            new = incoming & ~reached[targets]
+            reached[targets] |= new
+            frontier[:] = 0
+            frontier[targets] = new
+    return reached.reshape(nvertices, len(sourcesets), nbytes)
+
+def mcprobs( graph # Weighted directed network.
+           , concepts # Dictionary of concepts and their vertices.
+           , probability=None # Probability of edge presence.
+           , iterations=100 # How many times to simulate.
+           , seed=None # Seed for the random deletions.
+           , batchsize=None # At most this many at a time, else by memory.
+           ):
+    """Return MC path probabilities between all ordered pairs of concepts."""
+    names = list(concepts)
+    nvertices, tails, heads, _, _ = edgearrays(graph, [], [])
+    index = { v: i for i, v in enumerate(graph.nodes()) }
+    vertexsets = []
+    for c in names:
+        vertices = concepts[c]
+        if type(vertices) != list: vertices = [vertices]
+        for v in vertices:
+            if v not in index:
+                raise nx.NodeNotFound("Vertex %s not in graph." % v)
+        vertexsets.append([ index[v] for v in vertices ])
+    mtodelete = deletion(graph, probability)
+    rng = np.random.default_rng(seed)
+    if batchsize is None:
+        batchsize = mcbatchsize(nvertices, len(tails), len(vertexsets))
+    # Every sample is drawn once and serves all pairs of concepts.
+    npaths = np.zeros((len(names), len(names)), dtype=int)
+    for start in range(0, iterations, batchsize):
+        n = min(batchsize, iterations - start)
+        kept = keptedges(len(tails), mtodelete, n, rng)
+        reached = reachedfrom(nvertices, tails, heads, kept, vertexsets)
+        for j, sinks in enumerate(vertexsets):
+            done = np.bitwise_or.reduce(reached[sinks], axis=0)
+            hits = np.unpackbits(done, axis=1, count=n)
+            npaths[:, j] += hits.sum(axis=1, dtype=int)
+    return { (c1, c2): float(npaths[i, j] / iterations)
+             for i, c1 in enumerate(names)
+             for j, c2 in enumerate(names) if c1 != c2 }
+
+def interval(successes, trials, confidence=.95, method='wilson'):
+    """Return confidence interval of binomial proportion `successes/trials`."""
+    alpha = 1 - confidence
+    if method == 'wilson':
+        z = statistics.NormalDist().inv_cdf(1 - alpha / 2)
+        p = successes / trials
+        denominator = 1 + z**2 / trials
+        centre = (p + z**2 / (2 * trials)) / denominator
+        spread = z * math.sqrt( p * (1 - p) / trials
+                              + z**2 / (4 * trials**2) ) / denominator
+        return max(0.0, centre - spread), min(1.0, centre + spread)
+    elif method == 'clopper-pearson':
+        if successes == 0:
+            lo = 0.0
+        else:
+            lo = beta.ppf(alpha / 2, successes, trials - successes + 1)
+        if successes == trials:
+            hi = 1.0
+        else:
+            hi = beta.ppf(1 - alpha / 2, successes + 1, trials - successes)
+        return float(lo), float(hi)
+    else:
+        raise ValueError("Unknown interval method: %s" % method)
+
+def mcprob_adaptive( graph # Weighted directed network.
+                   , sources # Start vertices.
+                   , sinks # End vertices.
+                   , probability=None # Probability of edge presence.
+                   , halfwidth=.01 # Target half-width of confidence interval.
+                   , confidence=.95 # Confidence level of the interval.
+                   , method='wilson' # Or 'clopper-pearson'.
+                   , batchsize=100 # How many to simulate between checks.
+                   , maxiterations=10000 # How many to simulate at most.
+                   , seed=None # Seed for the random deletions.
+                   ):
+    """Return path probability, its confidence interval and samples used."""
+    # In case only one source or sink is provided, put them in a list anyway.
+    if type(sources) != list: sources = [sources]
+    if type(sinks) != list: sinks = [sinks]
+    mtodelete = deletion(graph, probability)
+    arrays = edgearrays(graph, sources, sinks)
+    rng = np.random.default_rng(seed)
+    # Simulate in batches until the interval is narrow enough.
+    npaths = iterations = 0
+    while iterations < maxiterations:
+        n = min(batchsize, maxiterations - iterations)
+        npaths += int(mcsample(arrays, mtodelete, n, rng).sum())
+        iterations += n
+        lo, hi = interval(npaths, iterations, confidence, method)
+        if (hi - lo) / 2 <= halfwidth:
+            break
+    return npaths / iterations, (lo, hi), iterations
+
 def weight(graph, edge):
     """Return the weight of the edge in the graph."""
     return graph[edge[0]][edge[1]]['weight']
 
+def between(graph, sources, sinks):
+    """Return subgraph of edges that can lie on a path from sources to sinks."""
+    down = set(sources).union(*[ nx.descendants(graph, v) for v in sources ])
+    up = set(sinks).union(*[ nx.ancestors(graph, v) for v in sinks ])
+    g = graph.subgraph(down & up)
+    # Edges into a source or out of a sink never help a path along.
+    return g.edge_subgraph([ (u, v) for (u, v) in g.edges
+                             if v not in sources and u not in sinks ])
+
+def factoring(nvertices, edges, ps, sources, sinks):
+    """Return exact probability that some sink is reachable from a source."""
+    target = sum(1 << v for v in sinks)
+    out = [ [] for _ in range(nvertices) ]
+    for i, (u, v) in enumerate(edges):
+        out[u].append(i)
+    memo = {}
+    # State is the set of reached vertices and the failed edges leaving it.
+    def f(reached, failed):
+        if reached & target:
+            return 1.0
+        if (reached, failed) in memo:
+            return memo[(reached, failed)]
+        # Condition on the first undecided edge leaving the reached set.
+        edge = next( ( i for u in range(nvertices) if reached >> u & 1
+                         for i in out[u]
+                         if not reached >> edges[i][1] & 1
+                         and not failed >> i & 1 )
+                   , None )
+        if edge is None:
+            p = 0.0
+        else:
+            head = edges[edge][1]
+            # Failed edges into the new vertex no longer matter.
+            unfailed = sum( 1 << i for i in range(len(edges))
+                            if failed >> i & 1 and edges[i][1] == head )
+            p = ( ps[edge] * f(reached | 1 << head, failed & ~unfailed)
+                + (1 - ps[edge]) * f(reached, failed | 1 << edge) )
+        memo[(reached, failed)] = p
+        return p
+    return f(sum(1 << v for v in sources), 0)
+
+def reliability( graph # Weighted directed network.
+               , sources # Start vertices.
+               , sinks # End vertices.
+               , probability=None # Probability of edge presence, or weights.
+               , maxedges=40 # Above this many edges, sample instead.
+               , iterations=10000 # How many times to simulate, if sampling.
+               , seed=None # Seed for the sampling.
+               ):
+    """Return probability of a path if edges exist independently."""
+    # In case only one source or sink is provided, put them in a list anyway.
+    if type(sources) != list: sources = [sources]
+    if type(sinks) != list: sinks = [sinks]
+    for v in sources + sinks:
+        if v not in graph:
+            raise nx.NodeNotFound("Vertex %s not in graph." % v)
+    if set(sources) & set(sinks):
+        return 1.0
+    # Only the edges between sources and sinks bear on the answer.
+    g = between(graph, sources, sinks)
+    if not any(v in g for v in sinks):
+        return 0.0
+    sources = [ v for v in sources if v in g ]
+    sinks = [ v for v in sinks if v in g ]
+    arrays = edgearrays(g, sources, sinks)
+    nvertices, tails, heads, sourceidx, sinkidx = arrays
+    if probability is None:
+        ps = np.array([ weight(g, edge) for edge in g.edges ], dtype=float)
+    else:
+        ps = np.full(len(tails), probability, dtype=float)
+    if len(tails) <= maxedges:
+        edges = list(zip(tails.tolist(), heads.tolist()))
+        return factoring(nvertices, edges, ps.tolist(), sourceidx, sinkidx)
+    # Too big to be exact, so keep each edge with its own probability.
+    rng = np.random.default_rng(seed)
+    npaths = int(mcsample(arrays, ps, iterations, rng).sum())
+    return npaths / iterations
+
 def collapse( graph # Weighted directed network.
             , source # Start vertex.
             , sink # End vertex.
             ):
-    # First check if `graph` is acyclic. If it is not, give up.
-    # if not nx.is_directed_acyclic_graph(graph):
-        # raise ValueError("Graph provided is not a directed acyclic graph.")
-    # First obtain all paths from `source` to `sink` and all edges in them.
-    allpaths = nx.all_simple_edge_paths(graph, source, sink)
-    alledges = [ edge for path in allpaths for edge in path ]
-    if not alledges:
+    """Return `graph` between `source` and `sink`, series-parallel reduced."""
+    g = nx.DiGraph(between(graph, [source], [sink]))
+    if sink not in g:
         nullgraph = nx.DiGraph()
         nullgraph.add_edge(source, sink)
         nullgraph[source][sink]['weight'] = 0.0
         return nullgraph
-    # Get the subgraph induced by these paths, ignoring repeated edges.
-    g = nx.DiGraph(nx.edge_subgraph(graph, alledges))
-    # Replace the weight attribute of each edge with a list of weights.
-    for edge in g.edges:
-        g.add_edge(*edge, weight=[weight(g, edge)])
-    vstoremove = []
-    newedges = []
-    for v in g:
-        # Only do this for internal collaps-able vertices.
-        if ( v is not source and
-             v is not sink and
-             g.in_degree(v) == 1 and
-             g.out_degree(v) == 1
-           ):
-            # Vertices incident from and to v, respectively.
-            v_in = list(g.predecessors(v))[0]
-            v_out = list(g.successors(v))[0]
-            # Edge to collapse to, may exist already.
-            newedge = v_in, v_out
-            # Keep the list current.
-            newedges.append(newedge)
-            # Combined probability of two consecutive edges existing.
-            newedgep = weight(g, (v_in, v))[0] * weight(g, (v, v_out))[0]
-            # If there is already an edge v_in, v_out, add p to list.
-            if newedge in g.edges:
-                g.add_edge(*newedge, weight=[*weight(g, newedge), newedgep])
-            # If not, make a new edge with only this p in the list.
-            else:
-                g.add_edge(*newedge, weight=[newedgep])
-            vstoremove.append(v)
-    g.remove_nodes_from(vstoremove)
-    # Now collapse the parallel edges.
-    for edge in g.edges:
-        if edge in newedges:
-            ps = weight(g, edge) # List of probabilities between one pair of vs.
-            ps = [ 1 - p for p in ps ] # Probabilities of edges _not_ existing.
-            p = 1 - math.prod(ps) # Probability of _some_ connection existing.
-            g.add_edge(*edge, weight=p)
-        else:
-            p = weight(g, edge)[0]
-            g.add_edge(*edge, weight=p)
-    # If only the source and sink remain, it is done.
-    if len(g) == 2:
-        return g
-    # Otherwise, have another go.
-    else:
-        print("# vertices:", len(list(g.nodes)))
-        return collapse(g, source, sink)
+    g.remove_edges_from(list(nx.selfloop_edges(g)))
+    # Parallel edges cannot exist in a DiGraph, so those are merged as they
+    # arise. What is left to do is the vertices that are merely in series.
+    worklist = list(g.nodes)
+    while worklist:
+        v = worklist.pop()
+        if ( v not in g or v == source or v == sink or
+             g.in_degree(v) != 1 or g.out_degree(v) != 1 ):
+            continue
+        v_in = next(iter(g.predecessors(v)))
+        v_out = next(iter(g.successors(v)))
+        # Combined probability of two consecutive edges existing.
+        p = weight(g, (v_in, v)) * weight(g, (v, v_out))
+        g.remove_node(v)
+        # A cycle through `v` alone never helps a path along.
+        if v_in != v_out:
+            if g.has_edge(v_in, v_out):
+                p = 1 - (1 - weight(g, (v_in, v_out))) * (1 - p)
+            g.add_edge(v_in, v_out, weight=p)
+        # Their degrees changed, so they may now be in series themselves.
+        worklist += [v_in, v_out]
+    return g
 
 def impedance(graph, source, sink):
+    """Return probability of a path from `source` to `sink`."""
     g = collapse(graph, source, sink)
-    edge = list(g.edges)[0]
-    return g[edge[0]][edge[1]]['weight']
+    if g.number_of_edges() == 1:
+        return weight(g, (source, sink))
+    # Not series-parallel, so compute what is left of it exactly.
+    return reliability(g, source, sink)
 
-def merge_ugraphs( graphs # List of NetworkX graphs.
-                 , probabilities # List of probabilities.
+def merge_ugraphs( graphs # NetworkX graphs, list or iterator.
+                 , probabilities # Probabilities, one per graph.
                  ):
     """Return union of uncertain graphs, using probabilities provided."""
-    # Make a NetworkX directed graph from simple union of graphs provided.
-    graph = nx.compose_all(graphs)
-    # Set weights using probabilities.
-    for edge in graph.edges:
-        # Get list of one-minus-probabilities of graphs containing this edge.
-        ps = [ 1 - probabilities[graphs.index(g)]
-               for g in graphs
-               if g.has_edge(*edge) ]
-        # Probability of edge is 1 - product(1 - p_i).
-        p = 1 - math.prod(ps)
-        # Set the weight with this probability
-        graph.add_edge(*edge, weight=p)
+    graph = None
+    # Sum of log(1 - p_i) over the graphs containing each edge.
+    logqs = collections.defaultdict(float)
+    for g, p in zip(graphs, probabilities):
+        if graph is None:
+            graph = g.__class__()
+        # Simple union, later graphs taking precedence as in `compose_all`.
+        graph.graph.update(g.graph)
+        graph.add_nodes_from(g.nodes(data=True))
+        graph.add_edges_from(g.edges(data=True))
+        logq = math.log1p(-p) if p < 1 else -math.inf
+        for (u, v) in g.edges():
+            logqs[(u, v) if g.is_directed() else frozenset((u, v))] += logq
+    if graph is None:
+        raise ValueError("cannot apply merge_ugraphs to an empty list")
+    # Probability of edge is 1 - product(1 - p_i).
+    for (u, v) in graph.edges():
+        logq = logqs[(u, v) if graph.is_directed() else frozenset((u, v))]
+        graph.add_edge(u, v, weight=-math.expm1(logq))
     # Deliver.
     return graph
 
@@ -152,6 +430,10 @@ def print_all_causal_paths( graph # Causal network.
                           , target='all' # Effect concept to consider.
                           , probability=.5 # Probability of edge presence.
                           , include_empty=False # Whether to show empty paths.
+                          , limit=None # Show at most this many paths per pair.
+                          , timeout=None # Seconds to spend per pair, at most.
+                          , count=False # Count paths, only showing top `k`.
+                          , k=3 # How many paths to show when counting.
                           ):
     if target == 'all':
         pairs = [ (from_concept, to_concept)
@@ -163,20 +445,51 @@ def print_all_causal_paths( graph # Causal network.
                   for from_concept in concepts
                   for to_concept in [target]
                   if from_concept != to_concept ]
+    if count:
+        # No enumeration, so this takes seconds even on dense graphs.
+        probs = mcprobs(graph, concepts, probability, iterations=10000)
+        counts = pathcounts(graph, concepts, pairs, k=k)
+        for (from_concept, to_concept) in pairs:
+            npaths, exact, ps = counts[(from_concept, to_concept)]
+            if not (include_empty or npaths):
+                continue
+            print("#======================================#")
+            print("# ", from_concept , "->" , to_concept)
+            print("#======================================#")
+            percentage = 100 * probs[(from_concept, to_concept)]
+            print("Overall probability of a path: %.0f%%" % percentage)
+            if exact:
+                print("Number of paths: %i" % npaths)
+            else:
+                print("Number of paths: at most %i" % npaths)
+            print()
+            for i, p in enumerate(ps): # For each example path...
+                print( "[ %i / %i ]" % (i+1, len(ps)))
+                print_path(p, labels)
+                print()
+        return
     for (from_concept, to_concept) in pairs:
+        # Finding one path is enough to know whether to print the header.
         ps = causal_paths( graph
                          , concepts[from_concept]
-                         , concepts[to_concept] )
-        if include_empty or ps:
+                         , concepts[to_concept]
+                         , limit=limit
+                         , timeout=timeout )
+        first = next(ps, None)
+        if include_empty or first is not None:
             print("#======================================#")
             print("# ", from_concept , "->" , to_concept)
             print("#======================================#")
+        # Carry on with the same search, so it runs once within `timeout`.
+        if first is not None:
+            ps = itertools.chain([first], ps)
         print_causal_paths( graph
                           , concepts[from_concept]
                           , concepts[to_concept]
                           , labels
                           , probability=probability
-                          , include_empty=include_empty)
+                          , include_empty=include_empty
+                          , paths=ps )
 
 
 def print_causal_paths( graph
@@ -184,52 +497,203 @@ def print_causal_paths( graph
                       , to_vertices
                       , labels
                       , probability=.5
-                      , include_empty=True ):
+                      , include_empty=True
+                      , limit=None
+                      , timeout=None
+                      , paths=None ): # Paths found already, to print instead.
     # If a vertex set is just a single vertex, put it in a list anyway.
     if type(from_vertices) != list:
         from_vertices = [from_vertices]
     if type(to_vertices) != list:
         to_vertices = [to_vertices]
-    ps = causal_paths(graph, from_vertices, to_vertices)
-    if ps: # If there is any causal path at all...
+    if paths is None:
+        ps = causal_paths( graph, from_vertices, to_vertices
+                         , limit=limit, timeout=timeout )
+    else:
+        ps = iter(paths)
+    first = next(ps, None)
+    i = 0 # Path counter.
+    if first is not None: # If there is any causal path at all...
         percentage = 100 * mcprob( graph
                                  , from_vertices, to_vertices
                                  , probability=probability
                                  , iterations=10000 )
         print("Overall probability of a path: %.0f%%" % percentage)
         print()
-        i = 0 # Path counter.
-        for p in ps: # For each path...
+        # Paths are printed as they are found.
+        for p in itertools.chain([first], ps): # For each path...
             i += 1
-            print( "[ %i / %i ]" % (i, len(ps)))
-            for v in range(len(p)): # Treat each vertex in the path...
-                if v == 0:
-                    print("(*) ", end='')
-                else:
-                    print("==> ", end='')
-                print(labels[p[v]])
+            print( "[ %i ]" % i)
+            print_path(p, labels)
             print()
     elif include_empty: # If there is no causal path and it needs to be shown.
         print( "[ 0 / 0 ], overall path probability = 0" )
         print()
-    return len(ps)
+    return i
+
+def print_path(path, labels):
+    for v in range(len(path)): # Treat each vertex in the path...
+        if v == 0:
+            print("(*) ", end='')
+        else:
+            print("==> ", end='')
+        print(labels[path[v]])
 
-def causal_paths(graph, from_vertices, to_vertices):
-    paths = []
+def causal_paths( graph # Causal network.
+                , from_vertices # Start vertices.
+                , to_vertices # End vertices.
+                , cutoff=10 # Longest path length to consider.
+                , limit=None # Yield at most this many paths.
+                , timeout=None # Stop yielding after this many seconds.
+                ):
+    """Yield simple paths from `from_vertices` to `to_vertices`, lazily."""
+    if type(from_vertices) != list: from_vertices = [from_vertices]
+    if type(to_vertices) != list: to_vertices = [to_vertices]
+    # Leaving out edges within to and from sets avoids over-counting.
+    excluded = ( list(graph.subgraph(from_vertices).edges())
+               + list(graph.subgraph(to_vertices).edges()) )
+    # A read-only view, so the graph of the caller stays as it is.
+    view = nx.restricted_view(graph, [], excluded)
+    if timeout is None:
+        deadline = None
+    else:
+        deadline = time.monotonic() + timeout
+    npaths = 0
+    if limit is not None and limit <= 0:
+        return
     for (fv, tv) in [ (fv, tv) for fv in from_vertices
                                for tv in to_vertices
                                if fv != tv ]:
-        # Removing edges in to and from sets avoids over-counting.
-        from_edges = list(graph.subgraph(from_vertices).edges())
-        to_edges = list(graph.subgraph(to_vertices).edges())
-        graph.remove_edges_from(from_edges + to_edges)
-        try:
-            newpaths = list(nx.all_simple_paths(graph, fv, tv, cutoff=10))
-        except nx.NetworkXNoPath:
-            pass
-        else:
-            paths += newpaths
-    return paths
+        for path in simple_paths(view, fv, tv, cutoff, deadline):
+            npaths += 1
+            yield path
+            # Stop right away, rather than search on for an unwanted path.
+            if limit is not None and npaths >= limit:
+                return
+        if deadline is not None and time.monotonic() > deadline:
+            return
+
+def simple_paths(graph, source, target, cutoff=None, deadline=None):
+    """Yield simple paths from `source` to `target` until `deadline`."""
+    for v in [source, target]:
+        if v not in graph:
+            raise nx.NodeNotFound("Vertex %s not in graph." % v)
+    if cutoff is not None and cutoff < 1:
+        return
+    # Only vertices that can reach the target at all are worth a visit.
+    reaching = nx.ancestors(graph, target) if graph.is_directed() \
+               else nx.node_connected_component(graph, target)
+    def successors(v):
+        # Try the target first, so a path is found before any detour.
+        vs = [ w for w in graph[v] if w in reaching and w != target ]
+        return iter([target] + vs if target in graph[v] else vs)
+    # Depth-first, with a stack of the successors still to try at each depth.
+    path = [source]
+    onpath = {source}
+    stack = [successors(source)]
+    while stack:
+        # The clock is checked at every step, not just when a path is found.
+        if deadline is not None and time.monotonic() > deadline:
+            return
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            onpath.discard(path.pop())
+        elif child == target:
+            yield path + [target]
+        elif child not in onpath and (cutoff is None or len(path) < cutoff):
+            path.append(child)
+            onpath.add(child)
+            stack.append(successors(child))
+
+def pathcounts( graph # Causal network.
+              , concepts # Dictionary of concepts => [ variables ].
+              , pairs=None # Pairs of concepts to do, or all ordered pairs.
+              , cutoff=10 # Longest path length to consider.
+              , k=3 # How many example paths to find per pair.
+              , weighted=False # Most probable rather than shortest examples.
+              ):
+    """Return path count, whether it is exact and top `k` paths, by pair."""
+    if pairs is None:
+        pairs = [ (c1, c2) for c1 in concepts for c2 in concepts if c1 != c2 ]
+    vertices = { c: concepts[c] if type(concepts[c]) == list
+                                else [concepts[c]] for c in concepts }
+    nodes = list(graph.nodes())
+    index = { v: i for i, v in enumerate(nodes) }
+    A = nx.to_scipy_sparse_array(graph, nodelist=nodes, weight=None).tocsr()
+    if cutoff is None:
+        cutoff = len(nodes)
+    # Vertices reachable from, and reaching, each concept.
+    down, up = {}, {}
+    for c in set(c for pair in pairs for c in pair):
+        for (reach, M) in [(down, A.T), (up, A)]:
+            x = np.zeros(len(nodes), dtype=bool)
+            x[[ index[v] for v in vertices[c] ]] = True
+            while True:
+                y = x | (M @ x > 0)
+                if (y == x).all():
+                    break
+                x = y
+            reach[c] = x
+    # Example paths come from a copy with a super source and a super sink.
+    h = nx.DiGraph(graph)
+    source, sink = object(), object()
+    counts = {}
+    for (c1, c2) in pairs:
+        fvs = [ index[v] for v in vertices[c1] ]
+        tvs = [ index[v] for v in vertices[c2] ]
+        # Edges within to and from sets are left out, as in `causal_paths`.
+        Afrom = A[fvs][:, fvs]
+        Ato = A[tvs][:, tvs]
+        # Walks of each length, by end vertex. On a DAG, walks are paths.
+        x = np.zeros(len(nodes))
+        x[fvs] = 1
+        npaths = 0.0
+        for _ in range(cutoff):
+            y = A.T @ x
+            y[fvs] -= Afrom.T @ x[fvs]
+            y[tvs] -= Ato.T @ x[tvs]
+            x = y
+            npaths += x[tvs].sum()
+            if not x.any():
+                break
+        # Exact if no cycle lies between the concepts, ignoring exclusions.
+        region = np.flatnonzero(down[c1] & up[c2])
+        B = A[region][:, region].tolil()
+        mask = np.isin(region, fvs)
+        B[np.ix_(mask, mask)] = 0
+        mask = np.isin(region, tvs)
+        B[np.ix_(mask, mask)] = 0
+        ncomponents = connected_components(B, connection='strong')[0]
+        exact = ncomponents == len(region) and not B.diagonal().any()
+        excluded = set( list(graph.subgraph(vertices[c1]).edges())
+                      + list(graph.subgraph(vertices[c2]).edges()) )
+        # Lazily search for the best few paths.
+        paths = []
+        if npaths > 0:
+            h.add_edges_from([ (source, v) for v in vertices[c1] ])
+            h.add_edges_from([ (v, sink) for v in vertices[c2] ])
+            def cost(u, v, d):
+                if (u, v) in excluded:
+                    return None
+                if not weighted or 'weight' not in d:
+                    return 1
+                return -math.log(d['weight']) if d['weight'] > 0 else None
+            try:
+                for p in nx.shortest_simple_paths(h, source, sink, cost):
+                    if len(paths) == k:
+                        break
+                    # Unweighted, paths come shortest first.
+                    if len(p) - 3 > cutoff:
+                        if weighted:
+                            continue
+                        break
+                    paths.append(p[1:-1])
+            except nx.NetworkXNoPath:
+                pass
+            h.remove_nodes_from([source, sink])
+        counts[(c1, c2)] = (round(npaths), exact, paths)
+    return counts
 
 def clean_edge_props(graph):
     """Destructively remove all edge properties save `width`."""
@@ -7,7 +7,7 @@
 # Last modified: 2023-05-05
 #
 
-import pickle, os
+import pickle, os, hashlib, shutil
 
 import numpy as np
 import pandas as pd
@@ -23,27 +23,182 @@ hilda_spss_path = project_path+"data/hilda2021/spss-210c/Combined u210c.sav"
 hilda_pickle_path = project_path+"data/hilda2020/hilda-combined-t200c.pickle"
 raw_pickle_path = project_path+"data/hilda2020/hilda-combined-t200c-raw.pickle"
 concept_path = project_path+"13days-analysis/concepts2hildavars.csv"
+cache_path = project_path+"data/hilda2021/cache/"
+
+# Rows to read at a time when cleaning into the cache. `None` reads all at once.
+clean_chunksize = None
+
+# Whether to downcast cleaned HILDA to compact dtypes, see `compact()`.
+compact_dtypes = False
+
+def runs(block):
+    """Return column, value and length of runs of equal values per column."""
+    nrows = block.shape[0]
+    # Sorting makes equal values consecutive, NaNs go to the end.
+    s = np.sort(block, axis=0)
+    starts = np.ones(s.shape, dtype=bool)
+    starts[1:] = s[1:] != s[:-1]
+    # Flatten column by column so that runs never straddle two columns.
+    flat = s.ravel(order='F')
+    positions = np.flatnonzero(starts.ravel(order='F'))
+    lengths = np.diff(np.append(positions, flat.size))
+    values = flat[positions]
+    # NaNs are not values. Keep them out.
+    valid = ~np.isnan(values)
+    return positions[valid] // nrows, values[valid], lengths[valid]
+
+def mergeruns(*runlists):
+    """Merge (column, value, count) triples, adding the counts."""
+    cols, values, counts = [ np.concatenate(arrays)
+                             for arrays in zip(*runlists) ]
+    order = np.lexsort((values, cols))
+    cols, values, counts = cols[order], values[order], counts[order]
+    starts = np.ones(cols.size, dtype=bool)
+    starts[1:] = (cols[1:] != cols[:-1]) | (values[1:] != values[:-1])
+    starts = np.flatnonzero(starts)
+    return cols[starts], values[starts], np.add.reduceat(counts, starts)
+
+def modes(cols, values, counts, ncols):
+    """Return the most common, on ties the smallest, value of each column."""
+    result = np.full(ncols, np.nan)
+    # By column, then by descending count, then by ascending value.
+    order = np.lexsort((values, -counts, cols))
+    cols, firsts = np.unique(cols[order], return_index=True)
+    result[cols] = values[order][firsts]
+    return result
 
 def clean(raw, fill='mode'):
     """Clean HILDA data."""
     # Exclude `object` cols containing wave ids, dates and other irrelevantia.
-    cleaned = raw.select_dtypes(include='float64').copy()
+    selected = raw.select_dtypes(include='float64')
+    block = selected.to_numpy(dtype='float64', copy=True)
     # Drop columns with only NaNs.
-    cleaned.dropna(axis='columns', how='all', inplace=True)
+    nans = np.isnan(block)
+    keep = ~nans.all(axis=0)
+    block, nans, columns = block[:, keep], nans[:, keep], selected.columns[keep]
     # Replace ramaining NaNs.
     if fill == 'mean':
         # Replace NaNs with mean values --- this messes up variables like `sex`.
-        cleaned.fillna(cleaned.mean().to_dict(), inplace=True)
+        fills = np.nanmean(block, axis=0)
     else:
         # Replace NaNs with most common values.
-        d = cleaned.mode().to_dict()
-        replacements = {key: val[0] for (key, val) in d.items()}
-        cleaned.fillna(replacements, inplace=True)
+        fills = modes(*runs(block), block.shape[1])
+    rows, cols = np.nonzero(nans)
+    block[rows, cols] = fills[cols]
     # Drop columns with only one value.
-    cols = [ col for col in cleaned.columns
-                 if pd.unique(cleaned[col]).shape[0]==1 ]
-    cleaned.drop(columns=cols, inplace=True)
-    return cleaned
+    varying = (block != block[:1]).any(axis=0)
+    return pd.DataFrame( block[:, varying]
+                       , index=raw.index
+                       , columns=columns[varying] )
+
+def chunks(path=None, chunksize=10000):
+    """Yield the SPSS file at `path` as data frames of `chunksize` rows."""
+    if path is None: path = hilda_spss_path
+    offset = 0
+    while True:
+        chunk, _ = pyreadstat.read_sav( path
+                                      , row_offset=offset
+                                      , row_limit=chunksize )
+        if chunk.shape[0] == 0:
+            break
+        # Number rows like they would be when reading the file in one go.
+        chunk.index = pd.RangeIndex(offset, offset + chunk.shape[0])
+        yield chunk
+        offset += chunk.shape[0]
+        if chunk.shape[0] < chunksize:
+            break
+
+def cleanstats(path=None, fill='mode', chunksize=10000):
+    """Return fill values of columns `clean()` keeps, and number of rows."""
+    columns = None
+    counted = None
+    sums = nonnans = 0
+    nrows = 0
+    for chunk in chunks(path, chunksize):
+        if columns is None:
+            columns = chunk.select_dtypes(include='float64').columns
+        block = chunk[columns].to_numpy(dtype='float64')
+        nrows += block.shape[0]
+        chunkruns = runs(block)
+        if counted is None:
+            counted = chunkruns
+        else:
+            counted = mergeruns(counted, chunkruns)
+        if fill == 'mean':
+            sums = sums + np.nansum(block, axis=0)
+            nonnans = nonnans + (~np.isnan(block)).sum(axis=0)
+    cols, values, counts = counted
+    # Columns with one distinct value are constant after filling, those with
+    # none only have NaNs. Drop both.
+    distinct = np.bincount(cols, minlength=len(columns))
+    keep = distinct > 1
+    if fill == 'mean':
+        fills = sums / np.where(nonnans > 0, nonnans, 1)
+    else:
+        fills = modes(cols, values, counts, len(columns))
+    return pd.Series(fills[keep], index=columns[keep]), nrows
+
+def cleanchunks(path=None, fill='mode', chunksize=10000, stats=None):
+    """Yield cleaned chunks of the SPSS file at `path`, see `cleanstats()`."""
+    if stats is None: stats = cleanstats(path, fill, chunksize)
+    fills, _ = stats
+    for chunk in chunks(path, chunksize):
+        yield chunk[fills.index].fillna(fills.to_dict())
+
+def compactdtype(values, codes=()):
+    """Return smallest dtype holding `values` and label `codes` exactly."""
+    values = np.asarray(values)
+    codes = np.asarray(list(codes), dtype='float64')
+    if values.dtype.kind in 'iu':
+        integral = True
+    elif values.dtype.kind == 'f':
+        integral = not np.isnan(values).any() and (values % 1 == 0).all()
+    else:
+        return values.dtype
+    # Integers go in the smallest integer type spanning values and codes.
+    if integral and (codes % 1 == 0).all():
+        lo = min(values.min(initial=0), codes.min(initial=0))
+        hi = max(values.max(initial=0), codes.max(initial=0))
+        for dtype in ['int8', 'int16', 'int32', 'int64']:
+            if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+    # Other numbers in single precision, if that loses nothing.
+    single = values.astype('float32')
+    if np.array_equal(single, values, equal_nan=True):
+        return np.dtype('float32')
+    return values.dtype
+
+def compact(data, meta=None, categorical=False, returnreport=False):
+    """Downcast each column of `data` to the smallest exact dtype."""
+    labels = {} if meta is None else meta.variable_value_labels
+    columns = {}
+    for col in data.columns.unique():
+        values = data[col].to_numpy()
+        codes = labels.get(col, {})
+        # Value-labelled columns whose values are all labels are categorical.
+        if categorical and codes and np.isin(values, list(codes)).all():
+            columns[col] = pd.Categorical( values
+                                         , categories=sorted(codes) )
+        else:
+            columns[col] = values.astype( compactdtype(values, codes.keys())
+                                        , copy=False )
+    compacted = pd.DataFrame(columns, index=data.index)[data.columns]
+    if returnreport:
+        return compacted, memoryreport(data, compacted)
+    else:
+        return compacted
+
+def memoryreport(before, after):
+    """Report memory used by data frames `before` and `after` compaction."""
+    nbytes = before.memory_usage(index=True, deep=True).sum()
+    nbytescompact = after.memory_usage(index=True, deep=True).sum()
+    return pd.Series( { "bytes": nbytes
+                      , "bytes compact": nbytescompact
+                      , "bytes saved": nbytes - nbytescompact
+                      , "ratio": nbytes / nbytescompact
+                      , "dtypes": after.dtypes.astype(str)
+                                              .value_counts()
+                                              .to_dict() } )
 
 def stats(data):
     """Some statistics of the data."""
@@ -341,67 +496,339 @@ ISCO88 ={ 11: "Legislators and senior officials"
         , 92: "Agricultural, fishery and related labourers"
         , 93: "Labourers in mining, construction, manufacturing and transport" }
 
-c2h = pd.read_csv(concept_path)
-concepts = { k: v['variable'].to_list() for k, v in c2h.groupby('concept') }
+# Columnar cache of cleaned HILDA. Each cache lives in its own directory, named
+# after the hash of the source file and the `fill` mode, holding one NumPy file
+# per column so that reads can be restricted to the columns actually needed.
+def hilda_source():
+    """Return path of the file cleaned HILDA is derived from."""
+    if os.path.exists(hilda_spss_path):
+        return hilda_spss_path
+    else:
+        return hilda_pickle_path
+
+def filehash(path, blocksize=2**20):
+    """Return hash of file at `path`, remembered as long as it is unchanged."""
+    stat = os.stat(path)
+    fingerprint = os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+    hashes_path = os.path.join(cache_path, "hashes.pickle")
+    if os.path.exists(hashes_path):
+        with open(hashes_path, "rb") as f:
+            hashes = pickle.load(f)
+    else:
+        hashes = {}
+    if fingerprint not in hashes:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+        hashes[fingerprint] = h.hexdigest()
+        os.makedirs(cache_path, exist_ok=True)
+        # Replace atomically, so concurrent readers never see half a pickle.
+        tmp = hashes_path + ".%i.tmp" % os.getpid()
+        with open(tmp, "wb") as f:
+            pickle.dump(hashes, f)
+        os.replace(tmp, hashes_path)
+    return hashes[fingerprint]
 
-# Variables relating to literature of causes/effects of job-satisfaction.
-variables = [ var for sublist in list(concepts.values()) for var in sublist ]
+def cachekey(path=None, fill='mode'):
+    """Return key of the cache of data cleaned from `path` with `fill`."""
+    if path is None: path = hilda_source()
+    return filehash(path) + '-' + fill
+
+def iscached(key):
+    """Tell whether there is a cache under `key`."""
+    return os.path.exists(os.path.join(cache_path, key))
+
+def writecache(data, meta, key):
+    """Write `data`, column by column, and `meta` to the cache under `key`."""
+    writecachechunks([data], data.columns, data.index.to_numpy(), meta, key)
+
+def writecachechunks(chunks, columns, index, meta, key):
+    """Write `chunks` of data with row `index` to the cache under `key`."""
+    directory = os.path.join(cache_path, key)
+    # Write to a temporary directory first so partial caches are never read.
+    tmp = directory + "-%i.tmp" % os.getpid()
+    os.makedirs(tmp)
+    try:
+        _writecachefiles(tmp, chunks, columns, index, meta)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    try:
+        os.replace(tmp, directory)
+    except OSError:
+        # Another process built the same cache first. Theirs is as good.
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(directory):
+            raise
 
-# Read the HILDA data one way or another.
-if os.path.exists(hilda_spss_path):
-    raw, meta = pyreadstat.read_sav(hilda_spss_path)
-    hilda = clean(raw)
-else:
+def _writecachefiles(tmp, chunks, columns, index, meta):
+    """Write the cache files of `chunks` with row `index` into `tmp`."""
+    np.save(os.path.join(tmp, "index.npy"), index)
+    paths = [ os.path.join(tmp, "%i.npy" % i) for i in range(len(columns)) ]
+    # Fill the column files chunk by chunk, never holding all of the data.
+    offset = 0
+    for chunk in chunks:
+        stop = offset + chunk.shape[0]
+        for path, col in zip(paths, columns):
+            values = chunk[col].to_numpy()
+            column = np.lib.format.open_memmap( path
+                                              , mode='r+' if offset else 'w+'
+                                              , dtype=values.dtype
+                                              , shape=(len(index),) )
+            column[offset:stop] = values
+            del column
+        offset = stop
+    with open(os.path.join(tmp, "columns.pickle"), "wb") as f:
+        pickle.dump(list(columns), f)
+    with open(os.path.join(tmp, "meta.pickle"), "wb") as f:
+        pickle.dump(meta, f)
+
+def cachechunked(path=None, fill='mode', chunksize=10000):
+    """Clean the SPSS file at `path` into the cache, `chunksize` rows a time."""
+    if path is None: path = hilda_spss_path
+    # First pass over the file collects the statistics, the second cleans.
+    stats = cleanstats(path, fill, chunksize)
+    fills, nrows = stats
+    _, meta = pyreadstat.read_sav(path, metadataonly=True)
+    writecachechunks( cleanchunks(path, fill, chunksize, stats)
+                    , fills.index
+                    , np.arange(nrows)
+                    , meta
+                    , cachekey(path, fill) )
+
+def readcache(key, columns=None):
+    """Read `columns` (default all) from the cache under `key`."""
+    directory = os.path.join(cache_path, key)
+    with open(os.path.join(directory, "columns.pickle"), "rb") as f:
+        allcolumns = pickle.load(f)
+    positions = { col: i for i, col in enumerate(allcolumns) }
+    columns = allcolumns if columns is None else list(columns)
+    # Memory-map the column files, so only the requested columns are read.
+    arrays = { col: np.load( os.path.join(directory, "%i.npy" % positions[col])
+                           , mmap_mode='r' )
+               for col in columns }
+    index = np.load(os.path.join(directory, "index.npy"))
+    data = pd.DataFrame(arrays, index=index, copy=True)
+    # Repeated columns are repeated, like they would be with `hilda[columns]`.
+    return data if len(arrays) == len(columns) else data[columns]
+
+def readcachemeta(key):
+    """Read the HILDA metadata from the cache under `key`."""
+    with open(os.path.join(cache_path, key, "meta.pickle"), "rb") as f:
+        return pickle.load(f)
+
+def hildacolumns(columns=None, fill='mode'):
+    """Return cleaned HILDA restricted to `columns`, using the cache."""
+    # No need to go to disk if the full data set is already in memory.
+    if fill == 'mode' and 'hilda' in _datasets:
+        hilda = _datasets['hilda']
+        return hilda if columns is None else hilda[list(columns)]
+    key = cachekey(fill=fill)
+    # Clean the data and fill the cache only the very first time.
+    if not iscached(key):
+        if os.path.exists(hilda_spss_path) and clean_chunksize is not None:
+            cachechunked(hilda_spss_path, fill, clean_chunksize)
+            data = readcache(key, columns)
+        else:
+            if os.path.exists(hilda_spss_path):
+                hilda = clean(dataset('raw'), fill=fill)
+            elif fill != 'mode':
+                # The pickle holds mode-filled data only; never cache it as
+                # if it were filled otherwise.
+                raise ValueError("fill=%r needs the SPSS file at %s"
+                                 % (fill, hilda_spss_path))
+            else:
+                hilda = _unpickle_hilda()[0]
+            writecache(hilda, dataset('meta'), key)
+            data = hilda if columns is None else hilda[list(columns)]
+    else:
+        data = readcache(key, columns)
+    # Downcast if so asked, e.g. to fit more workers in memory.
+    if compact_dtypes:
+        data = compact(data, dataset('meta'))
+    return data
+
+def first(x):
+    """Return first digit of 2-digit (ISCO) code `x`."""
+    return (x - x % 10) // 10
+
+def strata(data):
+    """Return (stratum, value) => sorted row positions index of `data`."""
+    concepts = dataset('concepts')
+    index = {}
+    # Index each distinct value of a column, row positions kept sorted.
+    def add(stratum, values):
+        order = np.argsort(values, kind='stable')
+        keys, starts = np.unique(values[order], return_index=True)
+        for key, rows in zip(keys, np.split(order, starts[1:])):
+            index[stratum, int(key) if key % 1 == 0 else key] = rows
+    # Sex.
+    sex = data['uhgsex'].to_numpy()
+    index['sex', 'male'] = np.flatnonzero(sex == 1)
+    index['sex', 'female'] = np.flatnonzero(sex == 2)
+    # Age in bands of ten years.
+    age = data[concepts['age'][0]].to_numpy()
+    for lo in range(0, 100, 10):
+        band = "%i-%i" % (lo, lo + 9)
+        index['age', band] = np.flatnonzero((age >= lo) & (age < lo + 10))
+    index['age', "100+"] = np.flatnonzero(age >= 100)
+    # ISCO by 2 digit code if like 21. By 1 digit code if like 2.
+    isco = data['ujbm682'].to_numpy()
+    add('isco', isco)
+    # Codes below 10 make way for the 1 digit codes.
+    codes = { code: index.pop((stratum, code)) if code < 10
+                    else index[stratum, code]
+              for (stratum, code) in list(index) if stratum == 'isco' }
+    for digit in range(10):
+        # Leave out ISCO1 and ISCO34 (dubious or too many).
+        rows = [ codes[code] for code in codes
+                 if code not in [1, 34] and first(code) == digit ]
+        if rows:
+            index['isco', digit] = np.sort(np.concatenate(rows))
+    # Socio-economic strata.
+    add('education', data[concepts['education'][0]].to_numpy())
+    add('seifa', data[concepts['seifa'][0]].to_numpy())
+    return index
+
+def intersectrows(rowsets, nrows):
+    """Return intersection of sorted row position arrays, all rows if none."""
+    if not rowsets:
+        return np.arange(nrows)
+    # Start from the smallest and look its rows up in the others.
+    rowsets = sorted(rowsets, key=len)
+    rows = rowsets[0]
+    for other in rowsets[1:]:
+        if other.size == 0:
+            return other
+        positions = np.searchsorted(other, rows).clip(max=other.size - 1)
+        rows = rows[other[positions] == rows]
+    return rows
+
+# Datasets are loaded lazily, i.e. on first access through `dataset()`, and then
+# cached. Importing this module therefore does not touch the HILDA files at all.
+loaders = {} # Dataset name => function that loads it.
+_datasets = {} # Dataset name => loaded dataset.
+
+def loader(name):
+    """Register the decorated function as the loader of dataset `name`."""
+    def register(f):
+        loaders[name] = f
+        return f
+    return register
+
+def dataset(name):
+    """Return dataset `name`, loading and caching it on first access."""
+    if name not in _datasets:
+        if name not in loaders:
+            raise KeyError("No such dataset: %s" % name)
+        _datasets[name] = loaders[name]()
+    return _datasets[name]
+
+def unload(name=None):
+    """Drop dataset `name`, or all datasets, from the cache."""
+    if name is None:
+        _datasets.clear()
+    else:
+        _datasets.pop(name, None)
+
+def __getattr__(name):
+    """Keep e.g. `unravel.hilda.meta` working, loading the dataset lazily."""
+    if name in loaders:
+        return dataset(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def _unpickle_hilda():
+    """Read cleaned HILDA and its metadata from the pickle, caching both."""
     with open(hilda_pickle_path, "rb") as f:
         hilda, meta = pickle.load(f)
-    with open(raw_pickle_path, "rb") as f:
-        raw = pickle.load(f)
+    _datasets.setdefault('meta', meta)
+    return hilda, meta
+
+@loader('raw')
+def _raw():
+    # Read the HILDA data one way or another.
+    if os.path.exists(hilda_spss_path):
+        raw, meta = pyreadstat.read_sav(hilda_spss_path)
+        _datasets.setdefault('meta', meta)
+        return raw
+    else:
+        with open(raw_pickle_path, "rb") as f:
+            return pickle.load(f)
 
-labels = { key: meta.column_names_to_labels[key] for key in variables }
+@loader('meta')
+def _meta():
+    # Only the metadata is needed, so do not read the data if avoidable.
+    key = cachekey()
+    if iscached(key):
+        return readcachemeta(key)
+    elif os.path.exists(hilda_spss_path):
+        _, meta = pyreadstat.read_sav(hilda_spss_path, metadataonly=True)
+        return meta
+    else:
+        return _unpickle_hilda()[1]
+
+loader('hilda')(hildacolumns)
+
+# Concepts and their HILDA variables, as well as the labels of the latter.
+loader('c2h')(lambda: pd.read_csv(concept_path))
+loader('concepts')(lambda: { k: v['variable'].to_list()
+                             for k, v in dataset('c2h').groupby('concept') })
+# Variables relating to literature of causes/effects of job-satisfaction.
+loader('variables')(lambda: [ var
+                              for sublist in dataset('concepts').values()
+                              for var in sublist ])
+loader('labels')(lambda: { key: dataset('meta').column_names_to_labels[key]
+                           for key in dataset('variables') })
 
 # Produce subsets of HILDA based on Fjalar, Brandon or Josh's columns.
-hildaf = hilda[fcols.keys()]
-hildab = hilda[bcols]
-hildaj = hilda[jcols.keys()]
-hilda1k = clean(raw.sample(n=1000, random_state=999))
-hilda100 = clean(raw.sample(n=100, random_state=999))
-hilda25 = clean(raw.sample(n=25, random_state=999))
-h25x500 = hilda25.sample(n=500, axis='columns', random_state=11)
+loader('hildaf')(lambda: hildacolumns(fcols.keys()))
+loader('hildab')(lambda: hildacolumns(bcols))
+loader('hildaj')(lambda: hildacolumns(jcols.keys()))
+loader('hilda1k')(lambda: clean(dataset('raw').sample( n=1000
+                                                     , random_state=999 )))
+loader('hilda100')(lambda: clean(dataset('raw').sample( n=100
+                                                      , random_state=999 )))
+loader('hilda25')(lambda: clean(dataset('raw').sample( n=25
+                                                     , random_state=999 )))
+loader('h25x500')(lambda: dataset('hilda25').sample( n=500, axis='columns'
+                                                  , random_state=11 ))
 # Below subset contains 'ujbmsall':
-h100x300 = hilda100.sample(n=300, axis='columns', random_state=99)
-h100x300_2 = hilda100.sample(n=300, axis='columns', random_state=9999)
+loader('h100x300')(lambda: dataset('hilda100').sample( n=300, axis='columns'
+                                                    , random_state=99 ))
+loader('h100x300_2')(lambda: dataset('hilda100').sample( n=300, axis='columns'
+                                                      , random_state=9999 ))
 
 # All the ISCO88 codes with rows in HILDA.
-iscosraw = [ int(code) for code in hilda['ujbm682'].unique() ]
+loader('iscosraw')(lambda: [ int(code)
+                             for code in dataset('hilda')['ujbm682'].unique() ])
 
-# Subsetting.
-iscos = [ (isco, hilda[hilda['ujbm682'] == isco].shape[0]) for isco in iscosraw
-          if isco not in [1, 34] # Dubious category (1) and +10k rows (34).
-        #  if isco % 10 != 0      # Not sure whether to include.
-        ]
+@loader('iscos')
+def _iscos():
+    codes, counts = np.unique(dataset('hilda')['ujbm682'], return_counts=True)
+    nrows = dict(zip(codes, counts))
+    # Subsetting.
+    return [ (isco, int(nrows[isco]))
+             for isco in dataset('iscosraw')
+             if isco not in [1, 34] # Dubious category (1) and +10k rows (34).
+           #  if isco % 10 != 0      # Not sure whether to include.
+           ]
 
 # ISCO codes with 100 or more rows.
-iscover100 = [ isco[0] for isco in iscos if isco[1] > 99 ]
+loader('iscover100')(lambda: [ isco[0] for isco in dataset('iscos')
+                                       if isco[1] > 99 ])
+
+# Row positions of the strata of HILDA, see `strata()`.
+loader('strata')(lambda: strata(dataset('hilda')))
 
 def hilda_by_isco(isco):
     """Get by 2 digit code if `isco` like 21. By 1 digit code if like 2."""
-    # Get available iscos - excluding ISCO1 and ISCO34 (dubious or too many).
-    iscos = [ int(code) for code in hilda['ujbm682'].unique()
-              if int(code) not in [1, 34] ]
-    # Inline convenience lookup functions.
-    def hilda_by_isco2d(isco_2d): return hilda[hilda['ujbm682'] == isco_2d]
-    def first(x): return (x - x % 10) // 10
-
-    # If a 2-digit code is requested.
-    if isco > 9:
-        return hilda_by_isco2d(isco)
-    # If a 1-digit code is requested.
-    else:
-        return pd.concat([ hilda[hilda['ujbm682'] == code]
-                           for code in iscos if first(code) == isco ])
+    rows = dataset('strata').get(('isco', isco), np.array([], dtype=int))
+    return dataset('hilda').take(rows)
 
 def labeldict(g):
     """Return hildavar to label dictionary for the vertices in `g`."""
+    meta = dataset('meta')
     return { col: meta.column_names_to_labels[col] for col in g.nodes() }
 
 def label(g):
@@ -416,8 +843,9 @@ def find(keywords, data=None):
                      for var, lab in data.items()
                      if keyword.lower() in lab.lower() }
         else:
+            labels = dataset('meta').column_names_to_labels
             return { var: lab
-                     for var, lab in meta.column_names_to_labels.items()
+                     for var, lab in labels.items()
                      if keyword.lower() in lab.lower() }
     d = {}
     for keyword in keywords:
@@ -426,6 +854,7 @@ def find(keywords, data=None):
 
 def finddf(keywords, data=None):
     d = find(keywords, data=data)
+    meta = dataset('meta')
     df = pd.DataFrame(columns=["variable", "label", "range"])
     for var, label in d.items():
         r = meta.value_labels[meta.variable_to_label[var]]
@@ -444,6 +873,7 @@ def findand(keywords, data=None):
 
 def finddfand(keywords, data=None):
     d = findand(keywords, data=data)
+    meta = dataset('meta')
     df = pd.DataFrame(columns=["variable", "label", "range"])
     for var, label in d.items():
         r = meta.value_labels[meta.variable_to_label[var]]
@@ -455,6 +885,7 @@ def finddfand(keywords, data=None):
     return df
 
 def finddfkeys(d):
+    meta = dataset('meta')
     df = pd.DataFrame(columns=["variable", "label", "range"])
     for var, label in d.items():
         r = meta.value_labels[meta.variable_to_label[var]]